@@ -0,0 +1,42 @@
+"""Замер стоимости подготовки текста поста на одного получателя.
+
+Запуск из корня репозитория:
+
+    python bench/render_cost.py [число_получателей]
+
+Раньше текст экранировался заново при каждой отправке; теперь он
+рендерится один раз на пост (render_post_text) и попадает в план
+отправки, так что на получателя остаётся только обращение к кешу.
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import build_send_plan, render_post_text
+
+# Пост около 3 КБ: текст с пунктуацией, ссылками и спойлерами
+POST_TEXT = "\n".join(
+    f"Пункт {i}: цена 1.5-2 тыс. (скидка!) — [подробнее](https://example.com/item_{i}?a=1) ||секрет {i}||"
+    for i in range(30)
+)
+
+def per_call(statement, number):
+    return min(timeit.repeat(statement, number=number, repeat=5)) / number
+
+def main():
+    recipients = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+    render = per_call(lambda: render_post_text.__wrapped__(POST_TEXT), 200)
+    plan = per_call(lambda: (render_post_text.cache_clear(), build_send_plan('text', POST_TEXT, None)), 200)
+    render_post_text(POST_TEXT)
+    cached = per_call(lambda: render_post_text(POST_TEXT), 100000)
+
+    print(f"Пост: {len(POST_TEXT.encode())} байт")
+    print(f"Рендер текста: {render * 1e6:.1f} мкс, план отправки целиком: {plan * 1e6:.1f} мкс (один раз на пост)")
+    print(f"На получателя: {cached * 1e6:.2f} мкс (кеш) вместо {render * 1e6:.1f} мкс при рендере на каждую отправку")
+    print(f"Рассылка на {recipients} получателей: {(plan + cached * recipients):.3f} с "
+          f"вместо {render * recipients:.1f} с")
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,46 @@
+"""Замер времени импорта main.py в чистом интерпретаторе.
+
+Запуск из корня репозитория:
+
+    python bench/startup_time.py [число_запусков]
+
+Печатает медиану времени `import main` и проверяет, что тяжёлые
+медиа-библиотеки (moviepy, PIL) при старте не загружаются. Подробную
+разбивку по модулям даёт `python -X importtime -c "import main"`.
+"""
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+PROBE = (
+    "import sys, time\n"
+    "started = time.perf_counter()\n"
+    "import main\n"
+    "elapsed = time.perf_counter() - started\n"
+    "heavy = [name for name in ('moviepy', 'PIL') if name in sys.modules]\n"
+    "print(elapsed, ','.join(heavy))\n"
+)
+
+def main():
+    runs = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+    timings = []
+    heavy = set()
+    for _ in range(runs):
+        output = subprocess.run(
+            [sys.executable, '-c', PROBE], cwd=ROOT, capture_output=True, text=True, check=True
+        ).stdout.split()
+        timings.append(float(output[0]))
+        if len(output) > 1:
+            heavy.update(output[1].split(','))
+    print(f"import main: медиана {statistics.median(timings):.3f} с, "
+          f"мин {min(timings):.3f} с, макс {max(timings):.3f} с ({runs} запусков)")
+    if heavy:
+        print(f"При старте загружены тяжёлые библиотеки: {', '.join(sorted(heavy))}")
+        sys.exit(1)
+    print("moviepy и PIL при старте не загружаются.")
+
+if __name__ == '__main__':
+    main()
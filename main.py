@@ -1,28 +1,41 @@
 
 import logging
 import os
+import time
 import tempfile
 import json
+import sys
+from array import array
+from bisect import bisect_left
+import heapq
+import itertools
+import random
+import hashlib
 import uuid
 import re
-from functools import wraps
+from functools import wraps, lru_cache
 from dotenv import load_dotenv
 import redis
+import httpx
 import asyncio
-from PIL import Image
-
-if not hasattr(Image, 'ANTIALIAS'):
-    Image.ANTIALIAS = Image.Resampling.LANCZOS
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import ExitStack
 
 from telegram import (
     Bot, Update, InputMediaPhoto, InputMediaVideo, InputMediaAudio,
     ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove
 )
+from telegram.error import BadRequest, ChatMigrated, Forbidden, InvalidToken, NetworkError, RetryAfter
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     ApplicationBuilder, CommandHandler, MessageHandler, filters,
-    ContextTypes, ConversationHandler
+    ContextTypes, ConversationHandler, BasePersistence, PersistenceInput,
+    BaseUpdateProcessor
 )
-from moviepy.editor import VideoFileClip
+
+STARTED_AT = time.monotonic()
 
 load_dotenv()
 
@@ -57,10 +70,773 @@ logger = logging.getLogger(__name__)
     SELECT_BOT              
 ) = range(22)
 
+_media_libs_lock = threading.Lock()
+_video_file_clip = None
+
+def load_video_file_clip():
+    """Лениво импортирует moviepy (imageio, numpy, ffmpeg) и PIL при первой обработке видео."""
+    global _video_file_clip
+    with _media_libs_lock:
+        if _video_file_clip is None:
+            started = time.monotonic()
+            from PIL import Image
+
+            if not hasattr(Image, 'ANTIALIAS'):
+                Image.ANTIALIAS = Image.Resampling.LANCZOS
+
+            from moviepy.editor import VideoFileClip
+            _video_file_clip = VideoFileClip
+            logger.info(f"Медиа-библиотеки загружены за {time.monotonic() - started:.2f} с.")
+    return _video_file_clip
+
 ADMIN_BOT_TOKEN = os.getenv('ADMIN_BOT_TOKEN')
 ALLOWED_USER_IDS = os.getenv('ALLOWED_USER_IDS', '')
 ALLOWED_USER_IDS = [int(uid.strip()) for uid in ALLOWED_USER_IDS.split(',') if uid.strip().isdigit()]
 
+# Режим webhook включается, если задан WEBHOOK_URL; иначе используется polling
+WEBHOOK_URL = os.getenv('WEBHOOK_URL', '').rstrip('/')
+WEBHOOK_PATH = os.getenv('WEBHOOK_PATH', 'webhook').strip('/')
+WEBHOOK_SECRET = os.getenv('WEBHOOK_SECRET') or None
+WEBHOOK_LISTEN = os.getenv('WEBHOOK_LISTEN', '0.0.0.0')
+WEBHOOK_PORT = int(os.getenv('PORT', '8443'))
+
+# Пул HTTP-соединений к Bot API для каждого отправляющего бота
+SEND_POOL_SIZE = int(os.getenv('SEND_POOL_SIZE', '32'))
+SEND_KEEPALIVE_EXPIRY = float(os.getenv('SEND_KEEPALIVE_EXPIRY', '30'))
+SEND_CONNECT_TIMEOUT = float(os.getenv('SEND_CONNECT_TIMEOUT', '5'))
+SEND_READ_TIMEOUT = float(os.getenv('SEND_READ_TIMEOUT', '10'))
+SEND_WRITE_TIMEOUT = float(os.getenv('SEND_WRITE_TIMEOUT', '10'))
+SEND_MEDIA_WRITE_TIMEOUT = float(os.getenv('SEND_MEDIA_WRITE_TIMEOUT', '60'))
+SEND_POOL_TIMEOUT = float(os.getenv('SEND_POOL_TIMEOUT', '10'))
+
+def build_http_request(pool_size):
+    """HTTPXRequest с явным размером пула, keep-alive и таймаутами."""
+    return HTTPXRequest(
+        connection_pool_size=pool_size,
+        connect_timeout=SEND_CONNECT_TIMEOUT,
+        read_timeout=SEND_READ_TIMEOUT,
+        write_timeout=SEND_WRITE_TIMEOUT,
+        media_write_timeout=SEND_MEDIA_WRITE_TIMEOUT,
+        pool_timeout=SEND_POOL_TIMEOUT,
+        httpx_kwargs={
+            'limits': httpx.Limits(
+                max_connections=pool_size,
+                max_keepalive_connections=pool_size,
+                keepalive_expiry=SEND_KEEPALIVE_EXPIRY
+            )
+        }
+    )
+
+# Локальное хранилище медиа, адресуемое по хешу содержимого. По умолчанию во временном каталоге,
+# который передеплой стирает: прерванные рассылки тогда продолжаются по file_id, запомненным
+# отправляющим ботом (см. SendPlan.file_ids); рассылку, не успевшую загрузить медиа, продолжить нельзя
+MEDIA_STORE_DIR = os.getenv('MEDIA_STORE_DIR', os.path.join(tempfile.gettempdir(), 'adminbot_media'))
+MEDIA_STORE_TTL = int(os.getenv('MEDIA_STORE_TTL', str(24 * 60 * 60)))
+MEDIA_STORE_MAX_BYTES = int(os.getenv('MEDIA_STORE_MAX_MB', '2048')) * 1024 * 1024
+MEDIA_STORE_GC_INTERVAL = int(os.getenv('MEDIA_STORE_GC_INTERVAL', '600'))
+
+class MediaStore:
+    """Хранит скачанные файлы под именем sha256 их содержимого.
+
+    Одинаковые загрузки хранятся один раз. Ссылки на файл держат посты
+    (и черновики админов); файлы без ссылок удаляются сборщиком мусора
+    по истечении TTL или при превышении лимита размера.
+    """
+
+    def __init__(self, root, ttl, max_bytes):
+        self.root = root
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self._refs = {}
+        os.makedirs(self.root, exist_ok=True)
+
+    def temp_path(self, suffix):
+        return os.path.join(self.root, f"tmp-{uuid.uuid4().hex}{suffix}")
+
+    def add(self, path, suffix):
+        """Переносит файл в хранилище и возвращает путь к его копии по хешу."""
+        digest = hashlib.sha256()
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b''):
+                digest.update(chunk)
+        stored_path = os.path.join(self.root, f"{digest.hexdigest()}{suffix}")
+        if os.path.exists(stored_path):
+            os.remove(path)
+            os.utime(stored_path)
+        else:
+            os.replace(path, stored_path)
+        return stored_path
+
+    async def download(self, telegram_file, suffix, owner):
+        temp_path = self.temp_path(suffix)
+        try:
+            await telegram_file.download_to_drive(temp_path)
+            stored_path = await asyncio.to_thread(self.add, temp_path, suffix)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+        self.acquire(owner, stored_path)
+        return stored_path
+
+    def derived_path(self, source_path, suffix):
+        """Путь к файлу, производному от файла хранилища (например, перекодированному), с тем же хешем."""
+        digest = os.path.basename(source_path).split('.', 1)[0]
+        return os.path.join(self.root, f"{digest}{suffix}")
+
+    def acquire(self, owner, path):
+        self._refs.setdefault(os.path.basename(path), set()).add(owner)
+
+    def release(self, owner, path=None):
+        """Снимает ссылку владельца с файла (или со всех его файлов, если path не указан)."""
+        names = [os.path.basename(path)] if path else list(self._refs)
+        for name in names:
+            owners = self._refs.get(name)
+            if owners is None:
+                continue
+            owners.discard(owner)
+            if not owners:
+                del self._refs[name]
+
+    def collect_garbage(self):
+        now = time.time()
+        unreferenced = []
+        total_size = 0
+        for entry in os.scandir(self.root):
+            if not entry.is_file():
+                continue
+            stat = entry.stat()
+            if entry.name in self._refs:
+                total_size += stat.st_size
+            elif now - stat.st_mtime > self.ttl:
+                self._remove(entry.path)
+            elif entry.name.startswith('tmp-'):
+                # Скачивание ещё идёт
+                total_size += stat.st_size
+            else:
+                total_size += stat.st_size
+                unreferenced.append((stat.st_mtime, stat.st_size, entry.path))
+
+        unreferenced.sort()
+        for _, size, path in unreferenced:
+            if total_size <= self.max_bytes:
+                break
+            self._remove(path)
+            total_size -= size
+        if total_size > self.max_bytes:
+            logger.warning(f"Хранилище медиа занимает {total_size} байт, но все файлы используются постами.")
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+        except OSError as e:
+            logging.error(f"Не удалось удалить файл хранилища {path}: {e}")
+
+media_store = MediaStore(MEDIA_STORE_DIR, MEDIA_STORE_TTL, MEDIA_STORE_MAX_BYTES)
+
+# Фоновые задачи бота (сборка мусора и т.п.), запущенные в post_init
+background_tasks = []
+
+async def media_store_gc_loop():
+    while True:
+        try:
+            await asyncio.to_thread(media_store.collect_garbage)
+        except Exception as e:
+            logging.error(f"Ошибка при очистке хранилища медиа: {e}")
+        await asyncio.sleep(MEDIA_STORE_GC_INTERVAL)
+
+def draft_owner(update):
+    """Владелец файлов, загруженных админом, пока пост ещё не опубликован."""
+    return f"draft:{update.effective_user.id}"
+
+# Скачивания медиа, идущие в фоне, пока админ продолжает составлять пост
+pending_downloads = {}
+
+def start_media_download(file_obj, suffix, owner):
+    """Запускает скачивание в фоне и сразу возвращает его идентификатор."""
+    async def download():
+        file = await file_obj.get_file()
+        return await media_store.download(file, suffix, owner)
+
+    download_id = uuid.uuid4().hex
+    pending_downloads[download_id] = asyncio.create_task(download())
+    return download_id
+
+def draft_media(file_obj, file_type, suffix, owner):
+    """Медиа черновика: идентификатор фонового скачивания и file_id админского бота, по которому файл можно скачать заново."""
+    return {
+        'type': file_type,
+        'download_id': start_media_download(file_obj, suffix, owner),
+        'source_file_id': file_obj.file_id,
+        'suffix': suffix
+    }
+
+async def resolve_media_downloads(bot, media_list, owner):
+    """Дожидается ещё не завершённых скачиваний и скачивает заново пропавшие с диска файлы.
+
+    Возвращает готовые медиа и число неудачных.
+    """
+    resolved = []
+    failed = 0
+    for item in media_list:
+        if not item.get('file_path') or not os.path.exists(item['file_path']):
+            task = pending_downloads.pop(item.get('download_id'), None)
+            try:
+                if task is not None:
+                    item['file_path'] = await task
+                elif item.get('source_file_id'):
+                    # Скачивание или сам файл потеряны при перезапуске, черновик же восстановлен из хранилища состояния
+                    file = await bot.get_file(item['source_file_id'])
+                    item['file_path'] = await media_store.download(file, item['suffix'], owner)
+                else:
+                    raise RuntimeError("файл не найден")
+            except Exception as e:
+                logging.error(f"Ошибка при скачивании файла: {e}")
+                failed += 1
+                continue
+        item.pop('download_id', None)
+        resolved.append(item)
+    return resolved, failed
+
+def cancel_media_downloads(download_ids):
+    for download_id in download_ids:
+        task = pending_downloads.pop(download_id, None)
+        if task is not None:
+            task.cancel()
+
+def discard_draft(update, context):
+    """Отменяет скачивания черновика и освобождает его файлы в хранилище."""
+    cancel_media_downloads(
+        [item['download_id'] for item in context.user_data.get('media', []) if item.get('download_id')]
+        + [item['download_id'] for item in context.user_data.get('queued_media', [])]
+        + [(context.user_data.get('current_media') or {}).get('download_id')]
+    )
+    # Файлы черновика остаются в хранилище до истечения TTL и могут пригодиться при повторной загрузке
+    media_store.release(draft_owner(update))
+
+# Повторы неудачных отправок
+SEND_RETRY_MAX_ATTEMPTS = int(os.getenv('SEND_RETRY_MAX_ATTEMPTS', '5'))
+SEND_RETRY_BASE_DELAY = float(os.getenv('SEND_RETRY_BASE_DELAY', '1'))
+SEND_RETRY_MAX_DELAY = float(os.getenv('SEND_RETRY_MAX_DELAY', '60'))
+
+SEND_ERROR_RETRYABLE = 'retryable'
+SEND_ERROR_RATE_LIMITED = 'rate_limited'
+SEND_ERROR_PERMANENT = 'permanent'
+
+def classify_send_error(error):
+    """Делит ошибки отправки на повторяемые, flood-лимит и постоянные."""
+    if isinstance(error, RetryAfter):
+        return SEND_ERROR_RATE_LIMITED
+    # BadRequest наследуется от NetworkError, поэтому проверяется раньше
+    if isinstance(error, (BadRequest, Forbidden, InvalidToken, ChatMigrated)):
+        return SEND_ERROR_PERMANENT
+    if isinstance(error, NetworkError):
+        return SEND_ERROR_RETRYABLE
+    return SEND_ERROR_PERMANENT
+
+def is_unreachable_recipient(error):
+    """Получатель недостижим (заблокировал бота, удалён, чат не найден) — дело не в посте."""
+    if isinstance(error, Forbidden):
+        return True
+    return isinstance(error, BadRequest) and 'chat not found' in error.message.lower()
+
+# Фрагменты текста BadRequest, означающие, что Telegram отверг сам пост (разметку, длину, файл), а не получателя
+POST_ERROR_MARKERS = (
+    "can't parse", 'entities', 'too long', 'must be non-empty', 'message text is empty',
+    'wrong file identifier', 'wrong remote file identifier', 'wrong type of the web page content',
+    'failed to get http url content', 'media_empty', 'photo_invalid_dimensions'
+)
+
+def is_post_error(error):
+    """Ошибка вызвана самим постом, и у других получателей она повторится.
+
+    Недостижимые получатели, смена id чата и исчерпанные сетевые повторы
+    к таким ошибкам не относятся.
+    """
+    if isinstance(error, UndeliverablePost):
+        return True
+    return isinstance(error, BadRequest) and any(marker in error.message.lower() for marker in POST_ERROR_MARKERS)
+
+def retry_after_seconds(error):
+    retry_after = error.retry_after
+    if hasattr(retry_after, 'total_seconds'):
+        retry_after = retry_after.total_seconds()
+    return float(retry_after)
+
+class RetryQueue:
+    """Отложенные повторы отправок с экспоненциальной задержкой и полным джиттером."""
+
+    def __init__(self, max_attempts, base_delay, max_delay):
+        self.max_attempts = max_attempts
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self._heap = []
+        self._counter = itertools.count()
+
+    def __len__(self):
+        return len(self._heap)
+
+    def backoff(self, attempt):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** (attempt - 1)))
+
+    def push(self, offset, attempt, delay):
+        """Планирует попытку номер attempt для получателя со смещением offset через delay секунд."""
+        heapq.heappush(self._heap, (time.monotonic() + delay, next(self._counter), offset, attempt))
+
+    def pop_due(self, limit=None):
+        now = time.monotonic()
+        due = []
+        while self._heap and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+            _, _, offset, attempt = heapq.heappop(self._heap)
+            due.append((offset, attempt))
+        return due
+
+    def offsets(self):
+        return {item[2] for item in self._heap}
+
+    def next_delay(self):
+        if not self._heap:
+            return 0
+        return max(0.0, self._heap[0][0] - time.monotonic())
+
+# Окно и сглаживание для измерения скорости рассылок бота
+THROUGHPUT_WINDOW = float(os.getenv('THROUGHPUT_WINDOW', '10'))
+THROUGHPUT_EWMA_ALPHA = float(os.getenv('THROUGHPUT_EWMA_ALPHA', '0.3'))
+
+# Размыкатели цепи для Redis и Bot API каждого отправляющего бота
+BREAKER_FAILURE_THRESHOLD = int(os.getenv('BREAKER_FAILURE_THRESHOLD', '5'))
+BREAKER_RESET_TIMEOUT = float(os.getenv('BREAKER_RESET_TIMEOUT', '30'))
+HEALTH_CHECK_INTERVAL = float(os.getenv('HEALTH_CHECK_INTERVAL', '10'))
+REDIS_SOCKET_TIMEOUT = float(os.getenv('REDIS_SOCKET_TIMEOUT', '5'))
+
+BREAKER_CLOSED = 'closed'
+BREAKER_OPEN = 'open'
+BREAKER_HALF_OPEN = 'half_open'
+
+class BackendUnavailable(Exception):
+    """Бэкенд бота недоступен: размыкатель открыт, запрос не выполнялся."""
+
+class CircuitBreaker:
+    """Размыкатель цепи: после серии сбоев запросы сразу отклоняются.
+
+    Через reset_timeout пропускается один пробный запрос (half-open):
+    успех замыкает цепь, сбой снова размыкает её.
+    """
+
+    def __init__(self, name, failure_threshold, reset_timeout):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self.last_error = None
+
+    @property
+    def available(self):
+        """Можно ли сейчас обращаться к бэкенду (цепь замкнута или пора пробовать)."""
+        return self.retry_in() == 0
+
+    def retry_in(self):
+        """Через сколько секунд будет разрешён пробный запрос (0 — можно сейчас)."""
+        if self.state == BREAKER_CLOSED:
+            return 0.0
+        return max(0.0, self.opened_at + self.reset_timeout - time.monotonic())
+
+    def allow(self):
+        if self.state == BREAKER_CLOSED:
+            return True
+        if self.retry_in() == 0:
+            # Пропускаем единственный пробный запрос; если он оборвётся (отмена задачи),
+            # через reset_timeout будет пропущен следующий
+            self.state = BREAKER_HALF_OPEN
+            self.opened_at = time.monotonic()
+            return True
+        return False
+
+    def record_success(self):
+        if self.state != BREAKER_CLOSED:
+            logger.info(f"{self.name}: связь восстановлена.")
+        self.state = BREAKER_CLOSED
+        self.failures = 0
+
+    def record_failure(self, error):
+        self.failures += 1
+        self.last_error = error
+        if self.state == BREAKER_HALF_OPEN or self.failures >= self.failure_threshold:
+            if self.state != BREAKER_OPEN:
+                logger.warning(f"{self.name}: размыкатель открыт после ошибки: {error}")
+            self.state = BREAKER_OPEN
+            self.opened_at = time.monotonic()
+
+    def status(self):
+        if self.state == BREAKER_CLOSED:
+            return "в норме" if not self.failures else f"в норме (сбоев подряд: {self.failures})"
+        if self.state == BREAKER_HALF_OPEN:
+            return "проверка связи"
+        return f"недоступен, проверка через {self.retry_in():.0f} с ({self.last_error})"
+
+def is_backend_failure(error):
+    """Ошибка говорит о проблеме с самим Bot API или токеном, а не с получателем."""
+    return isinstance(error, InvalidToken) or classify_send_error(error) == SEND_ERROR_RETRYABLE
+
+class GuardedRedis:
+    """Клиент Redis, все команды которого проходят через размыкатель."""
+
+    def __init__(self, client, breaker):
+        self._client = client
+        self._breaker = breaker
+
+    def _guard(self, method):
+        @wraps(method)
+        def guarded(*args, **kwargs):
+            if not self._breaker.allow():
+                raise BackendUnavailable(f"{self._breaker.name}: {self._breaker.last_error}")
+            try:
+                result = method(*args, **kwargs)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                self._breaker.record_failure(e)
+                raise
+            except Exception:
+                # Сервер ответил (например, ошибкой команды) — связь есть
+                self._breaker.record_success()
+                raise
+            self._breaker.record_success()
+            return result
+        return guarded
+
+    def _guard_iter(self, method):
+        """Обёртка для *_iter: запросы идут во время итерации, а не при создании генератора."""
+        @wraps(method)
+        def guarded(*args, **kwargs):
+            if not self._breaker.allow():
+                raise BackendUnavailable(f"{self._breaker.name}: {self._breaker.last_error}")
+            try:
+                yield from method(*args, **kwargs)
+            except (redis.ConnectionError, redis.TimeoutError) as e:
+                self._breaker.record_failure(e)
+                raise
+            self._breaker.record_success()
+        return guarded
+
+    def pipeline(self, *args, **kwargs):
+        pipe = self._client.pipeline(*args, **kwargs)
+        pipe.execute = self._guard(pipe.execute)
+        return pipe
+
+    def __getattr__(self, name):
+        attribute = getattr(self._client, name)
+        if not callable(attribute) or name == 'close':
+            return attribute
+        if name.endswith('_iter'):
+            return self._guard_iter(attribute)
+        return self._guard(attribute)
+
+# Сколько доставок копить в памяти перед записью в Redis одним пайплайном
+DELIVERY_FLUSH_EVERY = int(os.getenv('DELIVERY_FLUSH_EVERY', '100'))
+
+# Сколько дней хранить пост и данные о его доставке (0 — бессрочно)
+POST_RETENTION_DAYS = float(os.getenv('POST_RETENTION_DAYS', '30'))
+POST_RETENTION_SECONDS = int(POST_RETENTION_DAYS * 24 * 60 * 60) or None
+
+# Аренда рассылки: инстанс, выполняющий её, продлевает ключ аренды каждые JOB_LEASE_TTL / 3 секунд.
+# Прерванную рассылку подхватывает другой инстанс, только когда аренда истекла
+JOB_LEASE_TTL = int(os.getenv('JOB_LEASE_TTL', '30'))
+INSTANCE_ID = uuid.uuid4().hex
+
+# Карантин (по умолчанию выключен): недостижимые получатели не входят в снимки аудитории QUARANTINE_DAYS дней.
+# Вернуть чат раньше срока можно командой /unquarantine <chat_id>
+QUARANTINE_ENABLED = os.getenv('QUARANTINE_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+QUARANTINE_DAYS = float(os.getenv('QUARANTINE_DAYS', '30'))
+
+def pack_int64(values):
+    """Упаковывает int64 в строку little-endian, одинаковую на любой платформе."""
+    packed = array('q', values)
+    if sys.byteorder != 'little':
+        packed.byteswap()
+    return packed.tobytes()
+
+def unpack_int64(data):
+    values = array('q')
+    values.frombytes(data)
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return values
+
+class AudienceSnapshot:
+    """Получатели поста, зафиксированные один раз на момент запуска рассылки.
+
+    chat_id хранятся отсортированным массивом int64 (8 байт на получателя,
+    в Redis — упакованной строкой), доставки — битовой картой по смещению
+    в массиве. Рассылку можно делить на диапазоны смещений и продолжать
+    с любого смещения, а проверка «уже отправлено?» занимает O(1).
+    """
+
+    def __init__(self, bot_manager, post_id, chat_ids, delivered):
+        self.bot_manager = bot_manager
+        self.post_id = post_id
+        self.chat_ids = chat_ids
+        self.delivered = delivered
+        self._dirty_offsets = []
+        self._pending_messages = {}
+        self._quarantined = {}
+
+    @staticmethod
+    def audience_key(bot_name, post_id):
+        return f"bot:{bot_name}:post:{post_id}:audience"
+
+    @staticmethod
+    def delivered_key(bot_name, post_id):
+        return f"bot:{bot_name}:post:{post_id}:delivered"
+
+    @staticmethod
+    def messages_key(bot_name, post_id):
+        return f"bot:{bot_name}:post:{post_id}:messages"
+
+    @staticmethod
+    def message_ids_key(bot_name, post_id):
+        return f"bot:{bot_name}:post:{post_id}:message_ids"
+
+    @staticmethod
+    def message_counts_key(bot_name, post_id):
+        return f"bot:{bot_name}:post:{post_id}:message_counts"
+
+    @classmethod
+    def create(cls, bot_manager, post_id):
+        quarantined = bot_manager.quarantined_chat_ids()
+        chat_ids = array('q')
+        invalid = 0
+        for uid in bot_manager.redis_client.sscan_iter(bot_manager.chat_id_set, count=10000):
+            try:
+                chat_id = int(uid)
+            except ValueError:
+                invalid += 1
+                continue
+            if chat_id not in quarantined:
+                chat_ids.append(chat_id)
+        if invalid:
+            logger.error(f"Некоторые chat_id не являются числами ({invalid} шт.), они пропущены.")
+        chat_ids = array('q', sorted(chat_ids))
+
+        bot_manager.redis_binary.set(
+            cls.audience_key(bot_manager.bot_name, post_id), pack_int64(chat_ids), ex=POST_RETENTION_SECONDS
+        )
+        return cls(bot_manager, post_id, chat_ids, bytearray((len(chat_ids) + 7) // 8))
+
+    @classmethod
+    def load(cls, bot_manager, post_id):
+        packed = bot_manager.redis_binary.get(cls.audience_key(bot_manager.bot_name, post_id))
+        if packed is None:
+            return None
+        chat_ids = unpack_int64(packed)
+        delivered = bytearray((len(chat_ids) + 7) // 8)
+        stored = bot_manager.redis_binary.get(cls.delivered_key(bot_manager.bot_name, post_id)) or b''
+        delivered[:len(stored)] = stored[:len(delivered)]
+        return cls(bot_manager, post_id, chat_ids, delivered)
+
+    def __len__(self):
+        return len(self.chat_ids)
+
+    def offset_of(self, chat_id):
+        offset = bisect_left(self.chat_ids, chat_id)
+        if offset < len(self.chat_ids) and self.chat_ids[offset] == chat_id:
+            return offset
+        return None
+
+    # Биты упорядочены как в Redis SETBIT: смещение 0 — старший бит первого байта
+    def is_delivered(self, offset):
+        return bool(self.delivered[offset >> 3] & (0x80 >> (offset & 7)))
+
+    def mark_delivered(self, offset, message_ids):
+        self.delivered[offset >> 3] |= 0x80 >> (offset & 7)
+        self._dirty_offsets.append(offset)
+        self._pending_messages[self.chat_ids[offset]] = ','.join(str(message_id) for message_id in message_ids)
+        if len(self._dirty_offsets) >= DELIVERY_FLUSH_EVERY:
+            try:
+                self.flush()
+            except (redis.RedisError, BackendUnavailable) as e:
+                # Доставки остаются в буфере и запишутся следующим flush, когда Redis вернётся
+                logger.warning(f"Не удалось записать доставки поста {self.post_id}: {e}")
+
+    def quarantine(self, offset):
+        """Отправляет получателя в карантин (записывается вместе со следующим flush)."""
+        if QUARANTINE_ENABLED:
+            self._quarantined[self.chat_ids[offset]] = time.time()
+
+    def pending_offsets(self, start=0, stop=None):
+        stop = len(self.chat_ids) if stop is None else min(stop, len(self.chat_ids))
+        for offset in range(start, stop):
+            if not self.is_delivered(offset):
+                yield offset
+
+    def flush(self):
+        """Записывает накопленные доставки (биты и message_id) и карантин одним пайплайном."""
+        if not self._dirty_offsets and not self._quarantined:
+            return
+        bot_name = self.bot_manager.bot_name
+        pipe = self.bot_manager.redis_client.pipeline(transaction=False)
+        delivered_key = self.delivered_key(bot_name, self.post_id)
+        messages_key = self.messages_key(bot_name, self.post_id)
+        for offset in self._dirty_offsets:
+            pipe.setbit(delivered_key, offset, 1)
+        if self._pending_messages:
+            pipe.hset(messages_key, mapping=self._pending_messages)
+        if self._quarantined:
+            pipe.zadd(self.bot_manager.quarantine_key, self._quarantined)
+        if POST_RETENTION_SECONDS:
+            # Даже если рассылка так и не завершится, данные о доставке не останутся навсегда
+            pipe.expire(delivered_key, POST_RETENTION_SECONDS)
+            pipe.expire(messages_key, POST_RETENTION_SECONDS)
+        pipe.execute()
+        self._dirty_offsets = []
+        self._pending_messages = {}
+        self._quarantined = {}
+
+# Лимит отправок одного бота в секунду (Telegram допускает около 30)
+SEND_RATE_LIMIT = float(os.getenv('SEND_RATE_LIMIT', '25'))
+
+class SendScheduler:
+    """Делит лимит отправок одного бота между одновременными задачами.
+
+    Срочные задачи всегда идут первыми, остальные получают слоты
+    пропорционально весу (start-time fair queuing по виртуальному времени),
+    так что маленький пост не ждёт окончания большой рассылки.
+    """
+
+    def __init__(self, rate):
+        self.interval = 1.0 / rate
+        self.paused_until = 0.0
+        self._next_slot = 0.0
+        self._virtual_time = 0.0
+        self._waiting = []
+        self._dispatcher = None
+
+    def pause(self, seconds):
+        """Flood-лимит действует на весь бот: приостанавливаем все его отправки."""
+        self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+
+    async def acquire(self, job, cost=1):
+        """Ждёт слота для cost вызовов Bot API (пост из нескольких сообщений занимает несколько слотов)."""
+        future = asyncio.get_running_loop().create_future()
+        self._waiting.append((job, future, cost))
+        if self._dispatcher is None or self._dispatcher.done():
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        await future
+
+    def _start_tag(self, job):
+        return max(job.virtual_time, self._virtual_time)
+
+    async def _dispatch(self):
+        while self._waiting:
+            delay = max(self._next_slot, self.paused_until) - time.monotonic()
+            if delay > 0:
+                # За время сна могут прийти более срочные задачи, поэтому выбираем после него
+                await asyncio.sleep(delay)
+                continue
+
+            index = min(
+                range(len(self._waiting)),
+                key=lambda i: (self._waiting[i][0].priority != PRIORITY_URGENT, self._start_tag(self._waiting[i][0]), i)
+            )
+            job, future, cost = self._waiting.pop(index)
+            if future.done():
+                continue
+            # Справедливая очередь по времени начала: виртуальное время — метка обслуживаемой задачи
+            self._virtual_time = self._start_tag(job)
+            job.virtual_time = self._virtual_time + cost / job.weight
+            self._next_slot = max(self._next_slot, time.monotonic() - self.interval) + self.interval * cost
+            future.set_result(None)
+
+# Перекодирование аудио в голосовое сообщение (моно OGG/Opus)
+VOICE_BITRATE = os.getenv('VOICE_BITRATE', '32k')
+TRANSCODE_WORKERS = int(os.getenv('TRANSCODE_WORKERS', '2'))
+transcode_executor = ThreadPoolExecutor(max_workers=TRANSCODE_WORKERS, thread_name_prefix='transcode')
+
+def ffmpeg_binary():
+    binary = os.getenv('FFMPEG_BINARY')
+    if binary:
+        return binary
+    import imageio_ffmpeg
+    return imageio_ffmpeg.get_ffmpeg_exe()
+
+def transcode_to_voice_file(source_path, target_path):
+    subprocess.run(
+        [
+            ffmpeg_binary(), '-y', '-v', 'error', '-i', source_path,
+            '-vn', '-ac', '1', '-c:a', 'libopus', '-b:a', VOICE_BITRATE,
+            '-application', 'voip', '-f', 'ogg', target_path
+        ],
+        check=True,
+        capture_output=True
+    )
+
+async def transcode_to_voice(source_path, owner):
+    """Извлекает звук из любого аудио или видео и перекодирует его в голосовое сообщение.
+
+    Работа идёт в пуле потоков вне цикла событий. Результат кешируется
+    в хранилище медиа по хешу исходного файла.
+    """
+    target_path = media_store.derived_path(source_path, '.voice.ogg')
+    if os.path.exists(target_path):
+        os.utime(target_path)
+    else:
+        temp_path = media_store.temp_path('.ogg')
+        try:
+            await asyncio.get_running_loop().run_in_executor(
+                transcode_executor, transcode_to_voice_file, source_path, temp_path
+            )
+            os.replace(temp_path, target_path)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    media_store.acquire(owner, target_path)
+    return target_path
+
+# Требования Telegram для video_note
+VIDEO_NOTE_MAX_SIZE = 50 * 1024 * 1024  # 50 MB
+VIDEO_NOTE_MAX_DURATION = 60  # 60 seconds
+VIDEO_NOTE_DIMENSION = 640  # Квадратное видео 640x640
+
+class VideoNoteRejected(ValueError):
+    """Видео нельзя отправить как видео-сообщение; текст ошибки показывается админу."""
+
+def prepare_video_note_file(source_path):
+    """Проверяет видео и при необходимости обрезает его до квадрата 640x640.
+
+    Выполняется целиком в пуле потоков. Возвращает путь к готовому файлу
+    в хранилище медиа (исходный, если обработка не понадобилась).
+    """
+    if os.path.getsize(source_path) > VIDEO_NOTE_MAX_SIZE:
+        raise VideoNoteRejected("Видео слишком большое для видео-сообщения (максимум 50МБ).")
+    VideoFileClip = load_video_file_clip()
+    video_clip = VideoFileClip(source_path)
+    try:
+        if video_clip.duration > VIDEO_NOTE_MAX_DURATION:
+            raise VideoNoteRejected("Видео слишком длинное для видео-сообщения (максимум 60 секунд).")
+        width, height = video_clip.size
+        if width == VIDEO_NOTE_DIMENSION and height == VIDEO_NOTE_DIMENSION:
+            return source_path
+
+        new_size = min(width, height)
+        cropped_video = video_clip.crop(x_center=width/2, y_center=height/2, width=new_size, height=new_size)
+        resized_video = cropped_video.resize((VIDEO_NOTE_DIMENSION, VIDEO_NOTE_DIMENSION))
+        temp_path = media_store.temp_path('.mp4')
+        try:
+            resized_video.write_videofile(temp_path, codec='libx264', audio_codec='aac', logger=None)
+        except Exception:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+            raise
+    finally:
+        # Обрезанный и масштабированный клипы читают через тот же ридер, что и исходный
+        video_clip.close()
+
+    if os.path.getsize(temp_path) > VIDEO_NOTE_MAX_SIZE:
+        os.remove(temp_path)
+        raise VideoNoteRejected("Видео после обработки превышает ограничение в 50МБ.")
+    return media_store.add(temp_path, '.mp4')
+
 class SendingBotManager:
     def __init__(self, name, config):
         self.name = name 
@@ -73,25 +849,166 @@ class SendingBotManager:
         self.chat_id_set = config['CHAT_ID_COLUMN']
         self.bot_name = self.name 
 
-        self.redis_client = redis.Redis(
+        # Оба клиента Redis делят один размыкатель: сбой соединения у одного означает сбой и у другого
+        self.redis_breaker = CircuitBreaker(f"Redis {self.name}", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+        self.api_breaker = CircuitBreaker(f"Bot API {self.name}", BREAKER_FAILURE_THRESHOLD, BREAKER_RESET_TIMEOUT)
+
+        self.redis_client = GuardedRedis(redis.Redis(
             host=self.redis_host,
             port=self.redis_port,
             username=self.redis_username,
             password=self.redis_password,
             db=self.redis_db,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT,
             decode_responses=True
-        )
+        ), self.redis_breaker)
+        # Отдельный клиент без декодирования для упакованных бинарных значений
+        self.redis_binary = GuardedRedis(redis.Redis(
+            host=self.redis_host,
+            port=self.redis_port,
+            username=self.redis_username,
+            password=self.redis_password,
+            db=self.redis_db,
+            socket_timeout=REDIS_SOCKET_TIMEOUT,
+            socket_connect_timeout=REDIS_SOCKET_TIMEOUT
+        ), self.redis_breaker)
+
+        self.bot = Bot(token=self.bot_token, request=build_http_request(SEND_POOL_SIZE))
+        self.scheduler = SendScheduler(SEND_RATE_LIMIT)
+
+        # Скользящие средние: скорость рассылок (вызовов Bot API в секунду) и задержка одного вызова
+        self.throughput = None
+        self.latency = None
+        self._window_start = None
+        self._window_calls = 0
+        self._last_call = 0.0
+
+    @property
+    def available(self):
+        return self.redis_breaker.available and self.api_breaker.available
+
+    async def call_api(self, api_call):
+        """Выполняет вызов Bot API через размыкатель: при открытом сразу бросает BackendUnavailable."""
+        if not self.api_breaker.allow():
+            raise BackendUnavailable(f"{self.api_breaker.name}: {self.api_breaker.last_error}")
+        started = time.monotonic()
+        try:
+            result = await api_call()
+        except Exception as e:
+            if is_backend_failure(e):
+                self.api_breaker.record_failure(e)
+            else:
+                # Telegram ответил (ошибка касается получателя) — связь есть
+                self.api_breaker.record_success()
+            raise
+        self.api_breaker.record_success()
+        latency = time.monotonic() - started
+        self.latency = latency if self.latency is None else THROUGHPUT_EWMA_ALPHA * latency + (1 - THROUGHPUT_EWMA_ALPHA) * self.latency
+        return result
+
+    def record_broadcast_calls(self, calls):
+        """Учитывает вызовы Bot API рассылок; раз в THROUGHPUT_WINDOW секунд обновляет среднюю скорость."""
+        now = time.monotonic()
+        if self._window_start is None or now - self._last_call > THROUGHPUT_WINDOW:
+            # После простоя окно начинается заново, чтобы паузы между рассылками не занижали скорость
+            self._window_start, self._window_calls = now, 0
+        self._window_calls += calls
+        self._last_call = now
+        elapsed = now - self._window_start
+        if elapsed < THROUGHPUT_WINDOW:
+            return
+        sample = self._window_calls / elapsed
+        if self.throughput is None:
+            self.throughput = sample
+        else:
+            self.throughput = THROUGHPUT_EWMA_ALPHA * sample + (1 - THROUGHPUT_EWMA_ALPHA) * self.throughput
+        self._window_start, self._window_calls = now, 0
+        # Сохраняем, чтобы оценки после перезапуска опирались на прошлые рассылки
+        try:
+            self.redis_client.hset(f"bot:{self.bot_name}:stats", mapping={
+                'throughput': self.throughput,
+                'latency': self.latency or ''
+            })
+        except (redis.RedisError, BackendUnavailable) as e:
+            logger.warning(f"Не удалось сохранить статистику бота {self.name}: {e}")
+
+    def load_stats(self):
+        if self.throughput is not None:
+            return
+        stats = self.redis_client.hgetall(f"bot:{self.bot_name}:stats")
+        if stats.get('throughput'):
+            self.throughput = float(stats['throughput'])
+        if stats.get('latency') and self.latency is None:
+            self.latency = float(stats['latency'])
+
+    @property
+    def quarantine_key(self):
+        return f"bot:{self.bot_name}:quarantine"
+
+    def quarantined_chat_ids(self):
+        """chat_id в карантине (сортированное множество с временем попадания); устаревшие записи удаляются."""
+        if not QUARANTINE_ENABLED:
+            return set()
+        since = time.time() - QUARANTINE_DAYS * 24 * 60 * 60
+        pipe = self.redis_client.pipeline()
+        pipe.zremrangebyscore(self.quarantine_key, '-inf', f"({since}")
+        pipe.zrange(self.quarantine_key, 0, -1)
+        _, members = pipe.execute()
+        return {int(chat_id) for chat_id in members}
+
+    def release_quarantine(self, chat_id):
+        """Возвращает чат из карантина. Возвращает True, если он там был."""
+        return bool(self.redis_client.zrem(self.quarantine_key, chat_id))
+
+    def count_chat_members(self, chat_ids):
+        """Сколько из chat_ids входит в множество чатов бота."""
+        try:
+            return sum(self.redis_client.smismember(self.chat_id_set, chat_ids))
+        except redis.ResponseError:
+            # SMISMEMBER появился в Redis 6.2; на старых серверах проверяем по одному в пайплайне
+            pipe = self.redis_client.pipeline(transaction=False)
+            for chat_id in chat_ids:
+                pipe.sismember(self.chat_id_set, chat_id)
+            return sum(pipe.execute())
+
+    def audience_size(self):
+        """Возвращает (получателей для рассылки, из них в карантине): SCARD минус карантин."""
+        total = self.redis_client.scard(self.chat_id_set)
+        quarantined = list(self.quarantined_chat_ids())
+        in_audience = 0
+        for start in range(0, len(quarantined), 1000):
+            in_audience += self.count_chat_members(quarantined[start:start + 1000])
+        return total - in_audience, in_audience
+
+    async def check_health(self):
+        """Пробный запрос к бэкендам с открытым размыкателем, когда подошло время проверки."""
+        if self.redis_breaker.state != BREAKER_CLOSED and self.redis_breaker.available:
+            try:
+                await asyncio.to_thread(self.redis_client.ping)
+            except (redis.RedisError, BackendUnavailable):
+                pass
+        if self.api_breaker.state != BREAKER_CLOSED and self.api_breaker.available:
+            try:
+                await self.call_api(self.bot.get_me)
+            except Exception:
+                pass
 
-        self.bot = Bot(token=self.bot_token)
+    def health_line(self):
+        return f"{self.name}: Redis — {self.redis_breaker.status()}, Bot API — {self.api_breaker.status()}"
 
     def save_post(self, post_id, content, post_type, data, bot_name):
         key = f"bot:{bot_name}:post:{post_id}"
-        self.redis_client.hset(key, mapping={
+        pipe = self.redis_client.pipeline()
+        pipe.hset(key, mapping={
             'content': content,
             'post_type': post_type,
-            'data': data,
+            'data': data or '',
             'bot_name': bot_name
         })
+        if POST_RETENTION_SECONDS:
+            pipe.expire(key, POST_RETENTION_SECONDS)
+        pipe.execute()
 
     def get_post(self, post_id, bot_name):
         key = f"bot:{bot_name}:post:{post_id}"
@@ -104,41 +1021,213 @@ class SendingBotManager:
         key = f"bot:{bot_name}:post:{post_id}"
         self.redis_client.delete(key)
 
-    def add_sent_message(self, post_id, chat_id, message_id, bot_name):
-        key = f"bot:{bot_name}:post:{post_id}:messages"
-        self.redis_client.hset(key, chat_id, message_id)
+    def add_sent_message(self, post_id, chat_id, message_ids, bot_name):
+        key = AudienceSnapshot.messages_key(bot_name, post_id)
+        self.redis_client.hset(key, chat_id, ','.join(str(message_id) for message_id in message_ids))
 
     def get_sent_messages(self, post_id, bot_name):
-        key = f"bot:{bot_name}:post:{post_id}:messages"
-        messages = self.redis_client.hgetall(key)
-        if messages:
-            return messages
-        return {}
+        """Возвращает {chat_id: [message_id, ...]} (у медиагруппы несколько сообщений)."""
+        messages = self.redis_client.hgetall(AudienceSnapshot.messages_key(bot_name, post_id))
+        sent = {
+            chat_id: [int(message_id) for message_id in message_ids.split(',')]
+            for chat_id, message_ids in messages.items()
+        }
+
+        # Упакованная часть после compact_sent_messages: первый message_id и число сообщений по смещению в аудитории
+        pipe = self.redis_binary.pipeline(transaction=False)
+        pipe.get(AudienceSnapshot.message_ids_key(bot_name, post_id))
+        pipe.get(AudienceSnapshot.message_counts_key(bot_name, post_id))
+        pipe.get(AudienceSnapshot.audience_key(bot_name, post_id))
+        packed_ids, counts, audience = pipe.execute()
+        if packed_ids is not None and audience is not None:
+            for chat_id, first_id, count in zip(unpack_int64(audience), unpack_int64(packed_ids), counts):
+                if first_id:
+                    sent[str(chat_id)] = list(range(first_id, first_id + count))
+        return sent
 
     def delete_sent_messages(self, post_id, bot_name):
-        key = f"bot:{bot_name}:post:{post_id}:messages"
-        self.redis_client.delete(key)
+        self.redis_client.delete(
+            AudienceSnapshot.messages_key(bot_name, post_id),
+            AudienceSnapshot.message_ids_key(bot_name, post_id),
+            AudienceSnapshot.message_counts_key(bot_name, post_id),
+            AudienceSnapshot.audience_key(bot_name, post_id),
+            AudienceSnapshot.delivered_key(bot_name, post_id)
+        )
 
-    async def send_text_message(self, chat_id, text):
+    def compact_sent_messages(self, post_id):
+        """Переупаковывает message_id завершённой рассылки и ставит срок хранения на все ключи поста.
+
+        Хэш «chat_id → список id» занимает десятки байт на получателя.
+        Сообщения одной отправки (в том числе альбома) идут подряд, поэтому
+        для получателя из снимка аудитории достаточно первого id (int64)
+        и числа сообщений (байт), выровненных по смещению в аудитории.
+        В хэше остаются только получатели вне снимка и несмежные id.
+        """
+        bot_name = self.bot_name
+        messages_key = AudienceSnapshot.messages_key(bot_name, post_id)
+        snapshot = AudienceSnapshot.load(self, post_id)
+        if snapshot is not None and len(snapshot):
+            packed_ids = self.redis_binary.get(AudienceSnapshot.message_ids_key(bot_name, post_id))
+            if packed_ids is not None:
+                # Пост уже упакован (например, доставки дописала продолженная рассылка) — дополняем
+                first_ids = unpack_int64(packed_ids)
+                counts = bytearray(self.redis_binary.get(AudienceSnapshot.message_counts_key(bot_name, post_id)) or bytes(len(snapshot)))
+            else:
+                first_ids = array('q', bytes(8 * len(snapshot)))
+                counts = bytearray(len(snapshot))
+            residual = {}
+            for chat_id, message_ids in self.redis_client.hscan_iter(messages_key, count=1000):
+                ids = [int(message_id) for message_id in message_ids.split(',')]
+                offset = snapshot.offset_of(int(chat_id))
+                if offset is None or len(ids) > 255 or ids != list(range(ids[0], ids[0] + len(ids))):
+                    residual[chat_id] = message_ids
+                else:
+                    first_ids[offset] = ids[0]
+                    counts[offset] = len(ids)
+
+            pipe = self.redis_binary.pipeline()
+            pipe.set(AudienceSnapshot.message_ids_key(bot_name, post_id), pack_int64(first_ids))
+            pipe.set(AudienceSnapshot.message_counts_key(bot_name, post_id), bytes(counts))
+            pipe.delete(messages_key)
+            if residual:
+                pipe.hset(messages_key, mapping=residual)
+            pipe.execute()
+
+        if POST_RETENTION_SECONDS:
+            pipe = self.redis_client.pipeline(transaction=False)
+            for key in (
+                f"bot:{bot_name}:post:{post_id}",
+                messages_key,
+                AudienceSnapshot.message_ids_key(bot_name, post_id),
+                AudienceSnapshot.message_counts_key(bot_name, post_id),
+                AudienceSnapshot.audience_key(bot_name, post_id),
+                AudienceSnapshot.delivered_key(bot_name, post_id)
+            ):
+                pipe.expire(key, POST_RETENTION_SECONDS)
+            pipe.execute()
+
+    def job_lease_key(self, post_id):
+        return f"bot:{self.bot_name}:post:{post_id}:lease"
+
+    def claim_job_lease(self, post_id):
+        """Захватывает аренду рассылки, если её никто не держит."""
+        return bool(self.redis_client.set(self.job_lease_key(post_id), INSTANCE_ID, nx=True, ex=JOB_LEASE_TTL))
+
+    def refresh_job_lease(self, post_id):
+        """Продлевает аренду рассылки. Возвращает False, если аренда уже у другого инстанса."""
+        # GET и EXPIRE не атомарны, но аренда не истечёт между ними, пока продления идут чаще TTL
+        if self.redis_client.get(self.job_lease_key(post_id)) != INSTANCE_ID:
+            return False
+        self.redis_client.expire(self.job_lease_key(post_id), JOB_LEASE_TTL)
+        return True
+
+    def release_job_lease(self, post_id):
+        if self.redis_client.get(self.job_lease_key(post_id)) == INSTANCE_ID:
+            self.redis_client.delete(self.job_lease_key(post_id))
+
+    def mark_job_active(self, post_id, admin_chat_id, description, priority):
+        self.redis_client.set(self.job_lease_key(post_id), INSTANCE_ID, ex=JOB_LEASE_TTL)
+        self.redis_client.sadd(f"bot:{self.bot_name}:active_posts", post_id)
+        self.redis_client.hset(f"bot:{self.bot_name}:post:{post_id}", mapping={
+            'admin_chat_id': admin_chat_id if admin_chat_id is not None else '',
+            'job_description': description,
+            'job_priority': priority
+        })
+
+    def save_file_ids(self, post_id, file_ids):
+        self.redis_client.hset(f"bot:{self.bot_name}:post:{post_id}", 'file_ids', json.dumps(file_ids))
+
+    def save_job_cursor(self, post_id, cursor):
+        self.redis_client.hset(f"bot:{self.bot_name}:post:{post_id}", 'cursor', cursor)
+
+    def mark_job_finished(self, post_id):
+        self.redis_client.srem(f"bot:{self.bot_name}:active_posts", post_id)
+        self.release_job_lease(post_id)
+
+    def get_active_posts(self):
+        return self.redis_client.smembers(f"bot:{self.bot_name}:active_posts")
+
+    async def close(self):
+        """Закрывает HTTP-пул Bot API и соединения с Redis."""
         try:
-            escaped_text = escape_markdown_v2(text, preserve_markdown=True)
-            message = await self.bot.send_message(
-                chat_id=chat_id,
-                text=escaped_text,
-                parse_mode='MarkdownV2'
-            )
-            # Сохранение message_id для возможности удаления
-            self.add_sent_message(str(uuid.uuid4()), chat_id, message.message_id, self.bot_name)
-            return True
+            await self.bot.request.shutdown()
         except Exception as e:
-            logging.error(f"Ошибка при отправке текста через {self.bot_name} пользователю {chat_id}: {e}")
-            return False
+            logging.error(f"Ошибка при закрытии HTTP-клиента {self.bot_name}: {e}")
+        self.redis_client.close()
+        self.redis_binary.close()
+
+    async def send_plan(self, chat_id, plan):
+        """Выполняет шаги плана для одного получателя и возвращает message_id всех отправленных сообщений.
+
+        Ошибка первого шага пробрасывается (её классифицирует BroadcastJob).
+        После первого шага начало поста уже у получателя и повтор всей
+        отправки его продублировал бы, поэтому остальные шаги повторяются
+        здесь же, а если не удалось — получатель остаётся с частью поста.
+        """
+        messages = await self.send_step(chat_id, plan.steps[0])
+        plan.remember_file_ids(plan.steps[0], messages)
+        message_ids = [message.message_id for message in messages]
+        for step in plan.steps[1:]:
+            for attempt_number in itertools.count(1):
+                try:
+                    messages = await self.send_step(chat_id, step)
+                    break
+                except Exception as e:
+                    error_kind = classify_send_error(e)
+                    if error_kind == SEND_ERROR_RATE_LIMITED:
+                        self.scheduler.pause(retry_after_seconds(e))
+                        await asyncio.sleep(retry_after_seconds(e))
+                    elif error_kind == SEND_ERROR_RETRYABLE and attempt_number < SEND_RETRY_MAX_ATTEMPTS:
+                        await asyncio.sleep(random.uniform(0, min(SEND_RETRY_MAX_DELAY, SEND_RETRY_BASE_DELAY * 2 ** (attempt_number - 1))))
+                    else:
+                        logging.error(f"Пост доставлен пользователю {chat_id} через {self.bot_name} не полностью: {e}")
+                        return message_ids
+            plan.remember_file_ids(step, messages)
+            message_ids += [message.message_id for message in messages]
+        return message_ids
+
+    async def send_step(self, chat_id, step):
+        method = step['method']
+        if method == 'text':
+            return await self.send_text_message(chat_id, step['text'])
+        elif method == 'media_group':
+            return await self.send_media_group(chat_id, step['media'], step['caption'])
+        elif method in ('photo', 'video'):
+            return await self.send_single_media(chat_id, step['item'], step['caption'])
+        elif method == 'video_note':
+            return await self.send_video_note(chat_id, step['path'], step.get('file_id'))
+        elif method == 'voice':
+            return await self.send_voice(chat_id, step['path'], step.get('file_id'))
+        raise ValueError(f"Неизвестный шаг плана: {method}")
+
+    # Методы отправки принимают готовый MarkdownV2 из плана, возвращают отправленные
+    # сообщения и пробрасывают исключения: их классифицирует BroadcastJob.
+    # Медиа с известным file_id повторно не загружаются.
+    async def send_text_message(self, chat_id, text):
+        message = await self.bot.send_message(
+            chat_id=chat_id,
+            text=text,
+            parse_mode='MarkdownV2'
+        )
+        return [message]
+
+    async def send_single_media(self, chat_id, item, caption=None):
+        with ExitStack() as files:
+            send = self.bot.send_photo if item['type'] == 'photo' else self.bot.send_video
+            message = await send(
+                chat_id,
+                item.get('file_id') or files.enter_context(open(item['file_path'], 'rb')),
+                caption=caption,
+                parse_mode='MarkdownV2' if caption else None,
+                has_spoiler=item['has_spoiler']
+            )
+        return [message]
 
     async def send_media_group(self, chat_id, media_list, caption=None):
-        try:
+        with ExitStack() as files:
             telegram_media = []
             for idx, item in enumerate(media_list):
-                media_file = open(item['file_path'], 'rb')
+                media_file = item.get('file_id') or files.enter_context(open(item['file_path'], 'rb'))
                 if item['type'] == 'photo':
                     media = InputMediaPhoto(
                         media=media_file,
@@ -154,35 +1243,19 @@ class SendingBotManager:
                         parse_mode='MarkdownV2' if idx == 0 and caption else None
                     )
                 telegram_media.append(media)
-            messages = await self.bot.send_media_group(chat_id=chat_id, media=telegram_media)
-            if messages:
-                for message in messages:
-                    self.add_sent_message(str(uuid.uuid4()), chat_id, message.message_id, self.bot_name)
-                return True
-            return False
-        except Exception as e:
-            logging.error(f"Ошибка при отправке медиагруппы через {self.bot_name} пользователю {chat_id}: {e}")
-            return False
+            return list(await self.bot.send_media_group(chat_id=chat_id, media=telegram_media))
 
-    async def send_video_note(self, chat_id, video_note_path):
-        try:
-            with open(video_note_path, 'rb') as vf:
-                message = await self.bot.send_video_note(chat_id=chat_id, video_note=vf)
-            self.add_sent_message(str(uuid.uuid4()), chat_id, message.message_id, self.bot_name)
-            return True
-        except Exception as e:
-            logging.error(f"Ошибка при отправке видео-сообщения через {self.bot_name} пользователю {chat_id}: {e}")
-            return False
+    async def send_video_note(self, chat_id, video_note_path, file_id=None):
+        if file_id:
+            return [await self.bot.send_video_note(chat_id=chat_id, video_note=file_id)]
+        with open(video_note_path, 'rb') as vf:
+            return [await self.bot.send_video_note(chat_id=chat_id, video_note=vf)]
 
-    async def send_voice(self, chat_id, voice_path):
-        try:
-            with open(voice_path, 'rb') as af:
-                message = await self.bot.send_voice(chat_id=chat_id, voice=af)
-            self.add_sent_message(str(uuid.uuid4()), chat_id, message.message_id, self.bot_name)
-            return True
-        except Exception as e:
-            logging.error(f"Ошибка при отправке аудиосообщения через {self.bot_name} пользователю {chat_id}: {e}")
-            return False
+    async def send_voice(self, chat_id, voice_path, file_id=None):
+        if file_id:
+            return [await self.bot.send_voice(chat_id=chat_id, voice=file_id)]
+        with open(voice_path, 'rb') as af:
+            return [await self.bot.send_voice(chat_id=chat_id, voice=af)]
 
     async def delete_messages(self, chat_id, message_ids):
         try:
@@ -191,6 +1264,174 @@ class SendingBotManager:
         except Exception as e:
             logging.error(f"Ошибка при удалении сообщения через {self.bot_name} пользователю {chat_id}: {e}")
 
+# Разовая миграция: удаление хэшей сообщений, записанных под случайными UUID вместо ID поста
+MIGRATION_SCAN_COUNT = int(os.getenv('MIGRATION_SCAN_COUNT', '500'))
+MIGRATION_PAUSE = float(os.getenv('MIGRATION_PAUSE', '0.05'))
+
+async def remove_orphaned_message_keys(bot_manager):
+    """Удаляет bot:{name}:post:*:messages без хэша поста.
+
+    Ключи перебираются через SCAN небольшими порциями с паузами и
+    удаляются UNLINK (память освобождается в фоне), так что Redis не
+    блокируется. Курсор SCAN сохраняется, поэтому после перезапуска
+    миграция продолжается с того же места, а по завершении ставится
+    отметка и миграция больше не запускается.
+    """
+    bot_name = bot_manager.bot_name
+    marker_key = f"bot:{bot_name}:migrations:orphaned_messages"
+    cursor_key = f"{marker_key}:cursor"
+    redis_client = bot_manager.redis_client
+    if await asyncio.to_thread(redis_client.exists, marker_key):
+        return
+
+    cursor = int(await asyncio.to_thread(redis_client.get, cursor_key) or 0)
+    removed = 0
+    while True:
+        cursor, keys = await asyncio.to_thread(
+            redis_client.scan, cursor, match=f"bot:{bot_name}:post:*:messages", count=MIGRATION_SCAN_COUNT
+        )
+        if keys:
+            pipe = redis_client.pipeline(transaction=False)
+            for key in keys:
+                pipe.exists(key[:-len(':messages')])
+            orphaned = [key for key, post_exists in zip(keys, await asyncio.to_thread(pipe.execute)) if not post_exists]
+            if orphaned:
+                await asyncio.to_thread(redis_client.unlink, *orphaned)
+                removed += len(orphaned)
+        if cursor == 0:
+            break
+        await asyncio.to_thread(redis_client.set, cursor_key, cursor)
+        await asyncio.sleep(MIGRATION_PAUSE)
+
+    await asyncio.to_thread(redis_client.set, marker_key, int(time.time()))
+    await asyncio.to_thread(redis_client.delete, cursor_key)
+    logger.info(f"Миграция {bot_name}: удалено {removed} хэшей сообщений без поста.")
+
+async def run_migrations(sending_bots):
+    for bot_manager in sending_bots:
+        try:
+            await remove_orphaned_message_keys(bot_manager)
+        except Exception as e:
+            # Миграция продолжится с сохранённого курсора при следующем запуске
+            logging.error(f"Ошибка миграции ключей бота {bot_manager.name}: {e}")
+
+# Хранение состояния разговоров и user_data админов в Redis
+PERSISTENCE_INTERVAL = float(os.getenv('PERSISTENCE_INTERVAL', '5'))
+PERSISTENCE_PREFIX = os.getenv('PERSISTENCE_PREFIX', 'adminbot')
+# Сколько обновлений обрабатывается одновременно (по одному на пользователя)
+CONCURRENT_UPDATES = int(os.getenv('CONCURRENT_UPDATES', '16'))
+
+class RedisPersistence(BasePersistence):
+    """Хранит состояния ConversationHandler и user_data в Redis.
+
+    PTB копит изменения в памяти и сбрасывает их раз в update_interval
+    секунд, поэтому перезапуск теряет не больше одного интервала, а не
+    все недособранные посты.
+    """
+
+    def __init__(self, redis_client, prefix, update_interval):
+        super().__init__(
+            store_data=PersistenceInput(bot_data=False, chat_data=False, user_data=True, callback_data=False),
+            update_interval=update_interval
+        )
+        self.redis_client = redis_client
+        self.user_data_key = f"{prefix}:user_data"
+        self.conversations_prefix = f"{prefix}:conversations"
+
+    async def get_user_data(self):
+        raw = await asyncio.to_thread(self.redis_client.hgetall, self.user_data_key)
+        return {int(user_id): json.loads(data) for user_id, data in raw.items()}
+
+    async def update_user_data(self, user_id, data):
+        await asyncio.to_thread(self.redis_client.hset, self.user_data_key, user_id, json.dumps(data))
+
+    async def drop_user_data(self, user_id):
+        await asyncio.to_thread(self.redis_client.hdel, self.user_data_key, user_id)
+
+    async def refresh_user_data(self, user_id, user_data):
+        pass
+
+    async def get_conversations(self, name):
+        raw = await asyncio.to_thread(self.redis_client.hgetall, f"{self.conversations_prefix}:{name}")
+        return {tuple(json.loads(key)): json.loads(state) for key, state in raw.items()}
+
+    async def update_conversation(self, name, key, new_state):
+        redis_key = f"{self.conversations_prefix}:{name}"
+        if new_state is None:
+            await asyncio.to_thread(self.redis_client.hdel, redis_key, json.dumps(list(key)))
+        else:
+            await asyncio.to_thread(self.redis_client.hset, redis_key, json.dumps(list(key)), json.dumps(new_state))
+
+    # chat_data, bot_data и callback_data боту не нужны
+    async def get_chat_data(self):
+        return {}
+
+    async def update_chat_data(self, chat_id, data):
+        pass
+
+    async def drop_chat_data(self, chat_id):
+        pass
+
+    async def refresh_chat_data(self, chat_id, chat_data):
+        pass
+
+    async def get_bot_data(self):
+        return {}
+
+    async def update_bot_data(self, data):
+        pass
+
+    async def refresh_bot_data(self, bot_data):
+        pass
+
+    async def get_callback_data(self):
+        return None
+
+    async def update_callback_data(self, data):
+        pass
+
+    async def flush(self):
+        pass
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Обрабатывает обновления параллельно, но обновления одного пользователя — строго по очереди."""
+
+    def __init__(self, max_concurrent_updates):
+        # PTB берёт свой семафор ещё до do_process_update, и обновление, ждущее очереди своего
+        # пользователя, занимало бы слот. Поэтому его лимит снят, а настоящий берётся после блокировки
+        super().__init__(sys.maxsize)
+        self._running = asyncio.Semaphore(max_concurrent_updates)
+        self._locks = {}
+
+    async def do_process_update(self, update, coroutine):
+        user = update.effective_user if isinstance(update, Update) else None
+        if user is None:
+            async with self._running:
+                await coroutine
+            return
+        lock = self._locks.setdefault(user.id, asyncio.Lock())
+        async with lock, self._running:
+            await coroutine
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+def build_persistence_redis(sending_bots):
+    """Redis для состояния админского бота: ADMIN_REDIS_*, а без них — Redis первого отправляющего бота."""
+    if not os.getenv('ADMIN_REDIS_HOST'):
+        return sending_bots[0].redis_client
+    return redis.Redis(
+        host=os.getenv('ADMIN_REDIS_HOST'),
+        port=int(os.getenv('ADMIN_REDIS_PORT', '6379')),
+        username=os.getenv('ADMIN_REDIS_USERNAME'),
+        password=os.getenv('ADMIN_REDIS_PASSWORD'),
+        db=int(os.getenv('ADMIN_REDIS_DB', '0')),
+        decode_responses=True
+    )
+
 def admin_main_menu():
     keyboard = [
         [
@@ -238,39 +1479,156 @@ def select_bot_menu(sending_bots):
         keyboard.append([KeyboardButton(bot.name)])
     return ReplyKeyboardMarkup(keyboard, resize_keyboard=True, one_time_keyboard=True)
 
-def escape_markdown_v2(text, preserve_markdown=False):
-    link_pattern = re.compile(r'\[([^\]]+)\]\(([^)]+)\)')
-
-    def escape_link(match):
-        text_part = match.group(1)
-        url_part = match.group(2)
-        
-        text_part_escaped = escape_markdown_v2_basic(text_part, preserve_markdown)
-
-        url_part_escaped = url_part.replace('(', r'\(').replace(')', r'\)')
-        return f'[{text_part_escaped}]({url_part_escaped})'
-
-    text = link_pattern.sub(escape_link, text)
-
-    spoiler_pattern = re.compile(r'\|\|(.+?)\|\|')
+# Зарезервированные символы MarkdownV2 (экранируются в обычном тексте)
+_MDV2_PLAIN_RE = re.compile(r'([_*\[\]()~`>#+\-=|{}.!\\:])')
 
-    def escape_spoiler(match):
-        content = match.group(1)
-        content_escaped = escape_markdown_v2_basic(content, preserve_markdown)
-        return f'||{content_escaped}||'
+# Режим preserve_markdown: ссылки и спойлеры разбираются как разметка,
+# *, _, ~ и ` остаются как есть, остальные спецсимволы экранируются.
+_MDV2_MARKUP_RE = re.compile(
+    r'\[(?P<link_text>[^\]]+)\]\((?P<link_url>[^)]+)\)'
+    r'|\|\|(?P<spoiler>(?s:.+?))\|\|'
+    r'|(?P<char>[\\{}#+\-.!():=>|\[\]])'
+)
 
-    text = spoiler_pattern.sub(escape_spoiler, text)
+_MDV2_URL_RE = re.compile(r'([\\()])')
 
-    text = escape_markdown_v2_basic(text, preserve_markdown)
+def _escape_markup_token(match):
+    char = match.group('char')
+    if char is not None:
+        return '\\' + char
+    spoiler = match.group('spoiler')
+    if spoiler is not None:
+        return f"||{_MDV2_MARKUP_RE.sub(_escape_markup_token, spoiler)}||"
+    link_text = _MDV2_MARKUP_RE.sub(_escape_markup_token, match.group('link_text'))
+    link_url = _MDV2_URL_RE.sub(r'\\\1', match.group('link_url'))
+    return f'[{link_text}]({link_url})'
 
-    return text
+def escape_markdown_v2(text, preserve_markdown=False):
+    """Экранирует текст для MarkdownV2 за один проход по строке.
 
-def escape_markdown_v2_basic(text, preserve_markdown=False):
+    При preserve_markdown=True ссылки [текст](url) и спойлеры ||текст||
+    сохраняются как разметка, а их содержимое экранируется отдельно.
+    """
     if preserve_markdown:
-        escape_chars = r'([\\{}\#\+\-\.\!\(\):])'
-    else:
-        escape_chars = r'([\\`{}\#\+\-\.\!\(\)\[\]:])'
-    return re.sub(escape_chars, r'\\\1', text)
+        return _MDV2_MARKUP_RE.sub(_escape_markup_token, text)
+    return _MDV2_PLAIN_RE.sub(r'\\\1', text)
+
+@lru_cache(maxsize=256)
+def render_post_text(text):
+    """Готовый MarkdownV2 текста поста. Считается один раз на пост, а не на каждого получателя."""
+    return escape_markdown_v2(text, preserve_markdown=True)
+
+# Лимиты Telegram: длина текста сообщения, подписи к медиа и размер альбома
+TEXT_LIMIT = 4096
+CAPTION_LIMIT = 1024
+MEDIA_GROUP_LIMIT = 10
+
+class UndeliverablePost(ValueError):
+    """Пост нельзя отправить ни одному получателю, поэтому рассылка не начинается."""
+
+def telegram_length(text):
+    """Длина текста так, как её считает Telegram (в единицах UTF-16)."""
+    return len(text.encode('utf-16-le')) // 2
+
+# Символы форматирования, которые в тексте поста остаются разметкой и должны быть парными в каждой части
+_FORMATTING_CHARS = '*_~`'
+_TEXT_UNIT_RE = re.compile(r'\S+\s*|\s+')
+
+def _formatting_parity(raw):
+    return tuple(raw.count(char) % 2 for char in _FORMATTING_CHARS)
+
+def _post_text_units(text, limit):
+    """Делит текст на неделимые единицы (raw, rendered): слова с пробелами после них, ссылки и спойлеры.
+
+    Единицы длиннее limit делятся сразу: спойлер — на несколько спойлеров,
+    слово — посимвольно. Ссылку разделить нельзя.
+    """
+    units = []
+
+    def add_plain(plain):
+        for word in _TEXT_UNIT_RE.findall(plain):
+            rendered = escape_markdown_v2(word, preserve_markdown=True)
+            if telegram_length(rendered) <= limit:
+                units.append((word, rendered))
+                continue
+            piece = ''
+            for char in word:
+                if telegram_length(escape_markdown_v2(piece + char, preserve_markdown=True)) > limit:
+                    units.append((piece, escape_markdown_v2(piece, preserve_markdown=True)))
+                    piece = ''
+                piece += char
+            if piece:
+                units.append((piece, escape_markdown_v2(piece, preserve_markdown=True)))
+
+    position = 0
+    for match in _MDV2_MARKUP_RE.finditer(text):
+        if match.group('char') is not None:
+            continue
+        add_plain(text[position:match.start()])
+        position = match.end()
+        rendered = _escape_markup_token(match)
+        if match.group('link_text') is not None and telegram_length(rendered) <= limit:
+            # Для чётности форматирования важен только текст ссылки: '_' в URL — не разметка
+            units.append((match.group('link_text'), rendered))
+        elif telegram_length(rendered) <= limit:
+            units.append((match.group(0), rendered))
+        elif match.group('spoiler') is not None:
+            spoiler = match.group('spoiler')
+            # Части уже сбалансированы по форматированию, поэтому raw для них не нужен
+            for part in split_post_text(spoiler, limit - 4):
+                units.append(('', f"||{part}||"))
+        else:
+            raise UndeliverablePost(f"ссылка длиннее {limit} символов")
+    add_plain(text[position:])
+    return units
+
+def split_post_text(text, limit, first_limit=None):
+    """Делит текст поста на готовые MarkdownV2-части не длиннее limit (первая — не длиннее first_limit).
+
+    Резать можно только между словами, и только там, где символы
+    форматирования (*, _, ~, `) закрыты; по возможности — по переводу
+    строки. Ссылки и спойлеры не разрываются. Если форматирование не
+    закрывается в пределах части, бросает UndeliverablePost.
+    """
+    first_limit = limit if first_limit is None else first_limit
+    rendered = render_post_text(text)
+    if telegram_length(rendered) <= first_limit:
+        return [rendered] if rendered.strip() else []
+
+    parts = []
+    current = []
+    current_length = 0
+    for raw, piece in _post_text_units(text, min(limit, first_limit)):
+        current.append((raw, piece))
+        current_length += telegram_length(piece)
+        part_limit = limit if parts else first_limit
+        while current_length > part_limit:
+            # Последняя единица в часть не входит; ищем разрез среди предыдущих
+            word_cut = newline_cut = None
+            length = 0
+            parity = _formatting_parity('')
+            for index, (unit_raw, unit_piece) in enumerate(current[:-1]):
+                length += telegram_length(unit_piece)
+                if length > part_limit:
+                    break
+                parity = tuple(a ^ b for a, b in zip(parity, _formatting_parity(unit_raw)))
+                if any(parity):
+                    continue
+                word_cut = index + 1
+                # Перевод строки во второй половине части — лучшее место для разреза
+                if unit_raw.endswith('\n') and length >= part_limit // 2:
+                    newline_cut = index + 1
+            if word_cut is None:
+                # Разрез внутри форматирования Telegram отклонит, поэтому пост не отправляется вовсе
+                raise UndeliverablePost(f"форматирование (*, _, ~, `) не закрывается в пределах {part_limit} символов")
+            cut = newline_cut or word_cut
+            parts.append(''.join(piece for _, piece in current[:cut]).strip())
+            current = current[cut:]
+            current_length = sum(telegram_length(piece) for _, piece in current)
+            part_limit = limit
+    if current:
+        parts.append(''.join(piece for _, piece in current).strip())
+    return [part for part in parts if part]
 
 def allowed_users_only(func):
     @wraps(func)
@@ -283,14 +1641,601 @@ def allowed_users_only(func):
         return await func(update, context, *args, **kwargs)
     return wrapper
 
-async def get_user_ids(redis_client, set_name):
-    user_ids = redis_client.smembers(set_name)
-    try:
-        user_ids = [int(uid) for uid in user_ids]
-    except ValueError:
-        logger.error("Некоторые chat_id не являются числами.")
-        user_ids = []
-    return user_ids
+class SendPlan:
+    """Готовая последовательность вызовов Bot API для одного поста.
+
+    Строится один раз перед рассылкой: тексты уже экранированы и разбиты
+    под лимиты Telegram, альбомы — по MEDIA_GROUP_LIMIT медиа. Для каждого
+    получателя шаги выполняются по порядку (см. SendingBotManager.send_plan).
+    """
+
+    def __init__(self, steps):
+        self.steps = steps
+
+    @property
+    def cost(self):
+        """Сколько вызовов Bot API занимает отправка одному получателю."""
+        return len(self.steps)
+
+    def remember_file_ids(self, step, messages):
+        """Запоминает file_id загруженных медиа, чтобы остальным получателям отправлять их без загрузки."""
+        def file_id(message):
+            if message.photo:
+                return message.photo[-1].file_id
+            media = message.video or message.video_note or message.voice
+            return media.file_id if media else None
+
+        if step['method'] == 'media_group':
+            for item, message in zip(step['media'], messages):
+                item['file_id'] = item.get('file_id') or file_id(message)
+        elif step['method'] in ('photo', 'video'):
+            step['item']['file_id'] = step['item'].get('file_id') or file_id(messages[0])
+        elif step['method'] in ('video_note', 'voice'):
+            step['file_id'] = step.get('file_id') or file_id(messages[0])
+
+    def _file_holders(self):
+        """Элементы плана, в которых хранится file_id медиа, в порядке отправки."""
+        for step in self.steps:
+            if step['method'] == 'media_group':
+                yield from step['media']
+            elif step['method'] in ('photo', 'video'):
+                yield step['item']
+            elif step['method'] in ('video_note', 'voice'):
+                yield step
+
+    def file_ids(self):
+        """file_id всех медиа плана (пустой список, если медиа нет) или None, если загружены ещё не все."""
+        file_ids = [holder.get('file_id') for holder in self._file_holders()]
+        return file_ids if all(file_ids) else None
+
+    def apply_file_ids(self, file_ids):
+        """Подставляет сохранённые file_id: медиа отправляются без локальных файлов."""
+        for holder, file_id in zip(self._file_holders(), file_ids):
+            holder['file_id'] = file_id
+
+    def text_parts(self):
+        """Части текста по порядку и позиции их сообщений: [(индекс сообщения, 'text' | 'caption', текст)]."""
+        parts = []
+        position = 0
+        for step in self.steps:
+            if step['method'] == 'text':
+                parts.append((position, 'text', step['text']))
+            elif step.get('caption'):
+                parts.append((position, 'caption', step['caption']))
+            position += len(step['media']) if step['method'] == 'media_group' else 1
+        return parts
+
+def build_send_plan(post_type, content, data):
+    """Строит план отправки поста; если пост не может быть доставлен, бросает UndeliverablePost."""
+    if post_type == 'text':
+        parts = split_post_text(content, TEXT_LIMIT)
+        if not parts:
+            raise UndeliverablePost("пустой текст")
+        return SendPlan([{'method': 'text', 'text': part} for part in parts])
+    elif post_type in ('media', 'text_media'):
+        media = json.loads(data)
+        if not media:
+            raise UndeliverablePost("нет медиафайлов")
+        # Подпись, не помещающаяся в лимит, продолжается текстовыми сообщениями после медиа
+        parts = split_post_text(content, TEXT_LIMIT, first_limit=CAPTION_LIMIT) if post_type == 'text_media' else []
+        caption = parts[0] if parts else None
+        steps = []
+        for start in range(0, len(media), MEDIA_GROUP_LIMIT):
+            group = media[start:start + MEDIA_GROUP_LIMIT]
+            # В альбоме должно быть от двух медиа, одиночное отправляется отдельным методом
+            if len(group) == 1:
+                steps.append({'method': group[0]['type'], 'item': group[0], 'caption': caption})
+            else:
+                steps.append({'method': 'media_group', 'media': group, 'caption': caption})
+            caption = None
+        steps.extend({'method': 'text', 'text': part} for part in parts[1:])
+        return SendPlan(steps)
+    elif post_type == 'video_note':
+        return SendPlan([{'method': 'video_note', 'path': data}])
+    elif post_type == 'audio':
+        return SendPlan([{'method': 'voice', 'path': data}])
+    raise ValueError(f"Неизвестный тип поста: {post_type}")
+
+# Приоритеты задач отправки: срочные (удаление, правка) обгоняют остальные,
+# обычные и массовые делят лимит бота пропорционально весам
+PRIORITY_URGENT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_BULK = 2
+PRIORITY_WEIGHTS = {PRIORITY_URGENT: 8, PRIORITY_NORMAL: 4, PRIORITY_BULK: 1}
+PRIORITY_NAMES = {PRIORITY_URGENT: 'срочно', PRIORITY_NORMAL: 'обычно', PRIORITY_BULK: 'массово'}
+
+# Сколько запросов к Bot API одна задача держит одновременно
+BROADCAST_WORKERS = int(os.getenv('BROADCAST_WORKERS', '8'))
+
+# Пробная отправка: сначала админам и небольшой выборке аудитории, и только потом всем
+CANARY_ENABLED = os.getenv('CANARY_ENABLED', 'false').lower() in ('1', 'true', 'yes')
+CANARY_SIZE = int(os.getenv('CANARY_SIZE', '20'))
+CANARY_MAX_ERROR_RATE = float(os.getenv('CANARY_MAX_ERROR_RATE', '0.2'))
+
+# Выполняемые сейчас задачи отправки по job_id
+active_jobs = {}
+
+class SendJob:
+    """Задача, выполняющая вызовы Bot API в рамках лимита бота."""
+
+    def __init__(self, bot_manager, post_id, description, priority):
+        self.job_id = uuid.uuid4().hex[:8]
+        self.bot_manager = bot_manager
+        self.post_id = post_id
+        self.description = description
+        self.priority = priority
+        self.weight = PRIORITY_WEIGHTS[priority]
+        self.virtual_time = 0.0
+        self.total = 0
+        self.sent = 0
+        self.failed = 0
+        self.started_at = None
+        self.finished_at = None
+        self.task = None
+        # Выставляется при остановке бота: задача больше не берёт новых получателей
+        self.stopping = False
+        # Выставляется, если задачу отменили (например, при удалении поста)
+        self.cancelled = False
+        # Исключение, на котором задача оборвалась
+        self.error = None
+
+    @property
+    def elapsed(self):
+        if self.started_at is None:
+            return 0.0
+        return (self.finished_at or time.monotonic()) - self.started_at
+
+    @property
+    def throughput(self):
+        return self.sent / self.elapsed if self.elapsed > 0 else 0.0
+
+    async def call(self, api_call, cost=1):
+        """Дожидается своей очереди в планировщике бота и выполняет api_call() (cost вызовов Bot API)."""
+        if not self.bot_manager.api_breaker.available:
+            # Не тратим слот планировщика на заведомо отклонённый запрос
+            raise BackendUnavailable(f"{self.bot_manager.api_breaker.name}: {self.bot_manager.api_breaker.last_error}")
+        await self.bot_manager.scheduler.acquire(self, cost)
+        return await self.bot_manager.call_api(api_call)
+
+    async def run_each(self, items, handler, workers=BROADCAST_WORKERS):
+        """Обрабатывает items несколькими воркерами, разделяющими общий итератор."""
+        items = iter(items)
+
+        async def worker():
+            for item in items:
+                await handler(item)
+                if self.stopping:
+                    return
+
+        await asyncio.gather(*(worker() for _ in range(workers)))
+
+    async def process(self, items, handler):
+        """Обрабатывает items; запускается в фоне через start_job, как и рассылки."""
+        self.started_at = time.monotonic()
+        try:
+            await self.run_each(items, handler)
+        finally:
+            self.finished_at = time.monotonic()
+
+    def status_line(self):
+        return (f"{self.job_id} {self.bot_manager.name}: {self.description} [{PRIORITY_NAMES[self.priority]}] — "
+                f"{self.sent}/{self.total}, ошибок {self.failed}, {self.throughput:.1f} сообщ./с, {self.elapsed:.0f} с")
+
+class BroadcastJob(SendJob):
+    """Рассылка поста получателям снимка аудитории.
+
+    Уже доставленные получатели пропускаются, поэтому рассылку можно
+    продолжить с любого смещения. Сетевые ошибки и таймауты повторяются
+    из очереди с экспоненциальной задержкой; очередь разбирается между
+    основными отправками, поэтому здоровые получатели не ждут. RetryAfter
+    приостанавливает весь бот, постоянные ошибки (Forbidden, BadRequest)
+    не повторяются.
+    """
+
+    def __init__(self, bot_manager, post_id, snapshot, plan, description, priority, admin_chat_id=None):
+        super().__init__(bot_manager, post_id, description, priority)
+        self.snapshot = snapshot
+        self.plan = plan
+        self.admin_chat_id = admin_chat_id
+        self.total = len(snapshot)
+        self.retry_queue = RetryQueue(SEND_RETRY_MAX_ATTEMPTS, SEND_RETRY_BASE_DELAY, SEND_RETRY_MAX_DELAY)
+        self._in_flight = set()
+        self._handed_out = -1
+        # Ошибки, вызванные самим постом (см. is_post_error); ошибки получателей и сети не в счёт
+        self.post_errors = 0
+        self.last_error = None
+        # Причина остановки рассылки после пробной отправки и её получатели (повторно не отправляются)
+        self.aborted = None
+        self._canary_offsets = set()
+        # file_id медиа сохраняются в пост, как только бот загрузил их все (нужны для продолжения без файлов)
+        self._file_ids_saved = False
+
+    @property
+    def cursor(self):
+        """Смещение, с которого рассылку можно безопасно продолжить."""
+        return min(self._in_flight | self.retry_queue.offsets() | {self._handed_out + 1})
+
+    async def attempt(self, offset, attempt_number):
+        chat_id = self.snapshot.chat_ids[offset]
+        self._in_flight.add(offset)
+        # Пока Bot API бота недоступен, воркеры ждут пробного запроса, а не перебирают получателей
+        breaker = self.bot_manager.api_breaker
+        while breaker.retry_in() > 0 and not self.stopping:
+            await asyncio.sleep(breaker.retry_in())
+        # При отмене (дедлайн остановки) получатель остаётся в _in_flight, чтобы курсор не ушёл дальше него
+        try:
+            message_ids = await self.call(lambda: self.bot_manager.send_plan(chat_id, self.plan), self.plan.cost)
+        except Exception as e:
+            self._in_flight.discard(offset)
+            error = e
+        else:
+            self._in_flight.discard(offset)
+            self.snapshot.mark_delivered(offset, message_ids)
+            self.sent += 1
+            self.bot_manager.record_broadcast_calls(self.plan.cost)
+            if not self._file_ids_saved:
+                self.save_file_ids()
+            return
+
+        if isinstance(error, BackendUnavailable):
+            # Получатель не виноват: повторяем после восстановления связи, не расходуя попытку
+            self.retry_queue.push(offset, attempt_number, breaker.retry_in() or breaker.reset_timeout)
+            return
+
+        error_kind = classify_send_error(error)
+        if error_kind == SEND_ERROR_RATE_LIMITED:
+            delay = retry_after_seconds(error)
+            self.bot_manager.scheduler.pause(delay)
+            # Flood-лимит не считается неудачной попыткой
+            self.retry_queue.push(offset, attempt_number, delay)
+        elif error_kind == SEND_ERROR_RETRYABLE and attempt_number < self.retry_queue.max_attempts:
+            logger.warning(f"Повтор отправки пользователю {chat_id} через {self.bot_manager.bot_name} "
+                           f"(попытка {attempt_number}): {error}")
+            self.retry_queue.push(offset, attempt_number + 1, self.retry_queue.backoff(attempt_number))
+        else:
+            self.failed += 1
+            if is_unreachable_recipient(error):
+                self.snapshot.quarantine(offset)
+            elif is_post_error(error):
+                self.post_errors += 1
+                self.last_error = error
+            logging.error(f"Ошибка при отправке поста пользователю {chat_id} через {self.bot_manager.bot_name}: {error}")
+
+    def save_file_ids(self):
+        file_ids = self.plan.file_ids()
+        if file_ids is None:
+            return
+        try:
+            if file_ids:
+                self.bot_manager.save_file_ids(self.post_id, file_ids)
+            self._file_ids_saved = True
+        except (redis.RedisError, BackendUnavailable) as e:
+            # Попробуем снова после следующей доставки
+            logger.warning(f"Не удалось сохранить file_id медиа поста {self.post_id} через {self.bot_manager.bot_name}: {e}")
+
+    async def drain_retries(self):
+        while self.retry_queue and not self.stopping:
+            await asyncio.sleep(self.retry_queue.next_delay())
+            await asyncio.gather(*(
+                self.attempt(retry_offset, attempt_number)
+                for retry_offset, attempt_number in self.retry_queue.pop_due()
+            ))
+
+    async def run_canary(self, start, stop):
+        """Пробная отправка админам и случайной выборке из CANARY_SIZE получателей.
+
+        Заодно загружает медиа и запоминает их file_id в плане, так что
+        основная рассылка файлы уже не загружает. Возвращает False, если
+        доля ошибок поста выше CANARY_MAX_ERROR_RATE.
+        """
+        stop = len(self.snapshot) if stop is None else min(stop, len(self.snapshot))
+        offsets = range(start, stop)
+        canary_offsets = set(random.sample(offsets, min(CANARY_SIZE, len(offsets))))
+        # Доля считается только по отправкам с определённым исходом: доставлено или отвергнуто из-за поста
+        judged = 0
+        for chat_id in ALLOWED_USER_IDS:
+            offset = self.snapshot.offset_of(chat_id)
+            if offset is not None:
+                # Админ из аудитории получает пост как обычный получатель и помечается доставленным
+                canary_offsets.add(offset)
+                continue
+            try:
+                message_ids = await self.call(lambda: self.bot_manager.send_plan(chat_id, self.plan), self.plan.cost)
+            except Exception as e:
+                if is_post_error(e):
+                    judged += 1
+                    self.post_errors += 1
+                    self.last_error = e
+                logging.error(f"Ошибка пробной отправки поста админу {chat_id} через {self.bot_manager.bot_name}: {e}")
+            else:
+                judged += 1
+                # Админы вне аудитории попадают в сообщения поста, чтобы удаление и правка дошли и до них
+                self.bot_manager.add_sent_message(self.post_id, chat_id, message_ids, self.bot_manager.bot_name)
+
+        self._canary_offsets = canary_offsets
+        judged_before = self.sent + self.post_errors
+        await self.run_each(
+            sorted(offset for offset in canary_offsets if not self.snapshot.is_delivered(offset)),
+            lambda offset: self.attempt(offset, 1)
+        )
+        await self.drain_retries()
+        judged += self.sent + self.post_errors - judged_before
+
+        error_rate = self.post_errors / judged if judged else 0.0
+        if error_rate > CANARY_MAX_ERROR_RATE:
+            self.aborted = f"ошибок {self.post_errors} из {judged} ({error_rate:.0%}), последняя: {self.last_error}"
+            logger.warning(f"Рассылка поста {self.post_id} через {self.bot_manager.bot_name} остановлена после пробной отправки: {self.aborted}")
+            return False
+        logger.info(f"Пробная отправка поста {self.post_id} через {self.bot_manager.bot_name}: "
+                    f"ошибок {self.post_errors} из {judged}, рассылка продолжается.")
+        return True
+
+    async def keep_lease(self):
+        """Продлевает аренду рассылки, пока она идёт; потеряв аренду, задача останавливается."""
+        while True:
+            await asyncio.sleep(JOB_LEASE_TTL / 3)
+            try:
+                if not await asyncio.to_thread(self.bot_manager.refresh_job_lease, self.post_id):
+                    logger.warning(f"Аренда рассылки поста {self.post_id} через {self.bot_manager.bot_name} "
+                                   f"перешла к другому инстансу, рассылка останавливается.")
+                    self.stopping = True
+                    return
+            except (redis.RedisError, BackendUnavailable) as e:
+                logger.warning(f"Не удалось продлить аренду рассылки поста {self.post_id} через {self.bot_manager.bot_name}: {e}")
+
+    async def run(self, start=0, stop=None, canary=False):
+        """Рассылает в диапазоне смещений [start, stop) и возвращает число успешных доставок.
+
+        Пока рассылка идёт, пост числится в активных у бота. Если бот
+        останавливается, рассылка сохраняет курсор и продолжается после
+        перезапуска (см. resume_interrupted_jobs). С canary=True сначала
+        выполняется пробная отправка (run_canary).
+        """
+        self.started_at = time.monotonic()
+        self.total = len(range(start, len(self.snapshot) if stop is None else min(stop, len(self.snapshot))))
+        self._handed_out = start - 1
+        self.bot_manager.mark_job_active(self.post_id, self.admin_chat_id, self.description, self.priority)
+
+        def offsets():
+            for offset in self.snapshot.pending_offsets(start, stop):
+                self._handed_out = offset
+                if offset not in self._canary_offsets:
+                    yield offset
+            self._handed_out = len(self.snapshot) if stop is None else stop
+
+        async def handle(offset):
+            # Получатель уже выдан, но ждёт, пока воркер разберёт повторы
+            self._in_flight.add(offset)
+            for retry_offset, attempt_number in self.retry_queue.pop_due(1):
+                await self.attempt(retry_offset, attempt_number)
+            await self.attempt(offset, 1)
+
+        heartbeat = asyncio.create_task(self.keep_lease())
+        try:
+            if canary and not await self.run_canary(start, stop):
+                return self.sent
+            if not self.stopping:
+                await self.run_each(offsets(), handle)
+            await self.drain_retries()
+        finally:
+            heartbeat.cancel()
+            self.snapshot.flush()
+            self.finished_at = time.monotonic()
+            if self.stopping:
+                self.bot_manager.save_job_cursor(self.post_id, self.cursor)
+                # Без аренды рассылку сразу подхватит новый инстанс, а не через JOB_LEASE_TTL
+                self.bot_manager.release_job_lease(self.post_id)
+            else:
+                self.bot_manager.mark_job_finished(self.post_id)
+                try:
+                    await asyncio.to_thread(self.bot_manager.compact_sent_messages, self.post_id)
+                except Exception as e:
+                    logging.error(f"Ошибка при упаковке доставок поста {self.post_id} через {self.bot_manager.bot_name}: {e}")
+
+        return self.sent
+
+def start_job(job, coroutine, on_done):
+    """Запускает задачу в фоне, чтобы обработка обновлений (в том числе других админов) её не ждала."""
+    async def run():
+        try:
+            await coroutine
+        except asyncio.CancelledError:
+            job.cancelled = True
+            logger.info(f"Задача {job.job_id} ({job.description}) через {job.bot_manager.bot_name} отменена.")
+        except Exception as e:
+            job.error = e
+            logging.error(f"Ошибка в задаче {job.job_id} ({job.description}) через {job.bot_manager.bot_name}: {e}")
+        finally:
+            active_jobs.pop(job.job_id, None)
+        await on_done(job)
+
+    active_jobs[job.job_id] = job
+    job.task = asyncio.create_task(run())
+    return job.task
+
+async def cancel_post_jobs(bot_manager, post_id):
+    """Останавливает идущие рассылки поста (например, перед его удалением)."""
+    tasks = []
+    for job in list(active_jobs.values()):
+        if job.bot_manager is bot_manager and job.post_id == post_id and job.task is not None:
+            job.task.cancel()
+            tasks.append(job.task)
+    if tasks:
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def post_media_paths(post_type, data):
+    """Локальные файлы, которые нужны для рассылки поста."""
+    if post_type in ('media', 'text_media'):
+        return [item['file_path'] for item in json.loads(data)]
+    elif post_type in ('video_note', 'audio'):
+        return [data]
+    return []
+
+async def resume_interrupted_jobs(bot, sending_bots):
+    """Продолжает рассылки, прерванные остановкой бота, с сохранённого курсора.
+
+    Берутся только рассылки с истёкшей арендой: рассылку, которую ещё
+    выполняет другой инстанс (например, при поэтапной выкатке), не трогаем.
+    """
+    for bot_manager in sending_bots:
+        try:
+            active_posts = await asyncio.to_thread(bot_manager.get_active_posts)
+        except (redis.RedisError, BackendUnavailable) as e:
+            # Рассылки этого бота останутся активными в Redis и продолжатся при следующей проверке
+            logger.warning(f"Не удалось продолжить рассылки бота {bot_manager.name}: {e}")
+            continue
+        running = {job.post_id for job in active_jobs.values() if job.bot_manager is bot_manager}
+        for post_id in active_posts:
+            if post_id in running or not await asyncio.to_thread(bot_manager.claim_job_lease, post_id):
+                continue
+            post = await asyncio.to_thread(bot_manager.get_post, post_id, bot_manager.bot_name)
+            snapshot = await asyncio.to_thread(AudienceSnapshot.load, bot_manager, post_id) if post else None
+            if snapshot is None:
+                bot_manager.mark_job_finished(post_id)
+                continue
+
+            admin_chat_id = int(post['admin_chat_id']) if post.get('admin_chat_id') else None
+            try:
+                plan = build_send_plan(post['post_type'], post.get('content', ''), post.get('data'))
+            except UndeliverablePost as e:
+                logger.error(f"Не удалось продолжить рассылку поста {post_id} через {bot_manager.bot_name}: {e}")
+                bot_manager.mark_job_finished(post_id)
+                continue
+            all_paths = post_media_paths(post['post_type'], post.get('data'))
+            paths = [path for path in all_paths if os.path.exists(path)]
+            if post.get('file_ids'):
+                # Медиа уже загружены в Telegram: локальные файлы не нужны (их мог стереть передеплой)
+                plan.apply_file_ids(json.loads(post['file_ids']))
+            elif len(paths) < len(all_paths):
+                logger.error(f"Не удалось продолжить рассылку поста {post_id} через {bot_manager.bot_name}: медиафайлы не найдены.")
+                bot_manager.mark_job_finished(post_id)
+                if admin_chat_id is not None:
+                    await bot.send_message(
+                        chat_id=admin_chat_id,
+                        text=f"Рассылку поста {post_id} через бота {bot_manager.name} не удалось продолжить после перезапуска: медиафайлы утеряны."
+                    )
+                continue
+
+            for path in paths:
+                media_store.acquire(post_id, path)
+            job = BroadcastJob(
+                bot_manager, post_id, snapshot, plan,
+                post.get('job_description', 'пост'), int(post.get('job_priority', PRIORITY_NORMAL)), admin_chat_id
+            )
+            start_job(job, job.run(start=int(post.get('cursor', 0))), notify_admin(
+                bot, admin_chat_id,
+                f"Рассылка поста через бота {bot_manager.name} завершена после перезапуска.\nID поста: {post_id}.",
+                cleanup=lambda post_id=post_id: media_store.release(post_id)
+            ))
+            logger.info(f"Рассылка поста {post_id} через {bot_manager.bot_name} продолжена с смещения {post.get('cursor', 0)}.")
+
+async def resume_jobs_loop(bot, sending_bots):
+    """Возобновляет прерванные рассылки при запуске, а затем периодически подхватывает те,
+    аренду которых отпустил или потерял другой инстанс.
+
+    Сборка мусора в хранилище медиа стартует только после первого прохода:
+    до него файлы прерванных рассылок никем не захвачены.
+    """
+    gc_started = False
+    while True:
+        try:
+            await resume_interrupted_jobs(bot, sending_bots)
+        except Exception as e:
+            logging.error(f"Ошибка при возобновлении прерванных рассылок: {e}")
+        if not gc_started:
+            background_tasks.append(asyncio.create_task(media_store_gc_loop()))
+            gc_started = True
+        await asyncio.sleep(JOB_LEASE_TTL)
+
+async def drain_jobs(deadline):
+    """Останавливает задачи: новые получатели не берутся, идущие запросы дожидаются до дедлайна."""
+    jobs = list(active_jobs.values())
+    for job in jobs:
+        job.stopping = True
+    tasks = [job.task for job in jobs if job.task is not None]
+    if not tasks:
+        return
+    logger.info(f"Ожидание завершения {len(tasks)} задач (не дольше {deadline:.0f} с)...")
+    _, pending = await asyncio.wait(tasks, timeout=deadline)
+    for task in pending:
+        task.cancel()
+    if pending:
+        await asyncio.gather(*pending, return_exceptions=True)
+
+def broadcast_priority(post_type):
+    return PRIORITY_NORMAL if post_type == 'text' else PRIORITY_BULK
+
+def estimate_broadcast(bot_manager, recipients, plan, priority):
+    """Оценивает длительность рассылки в секундах и скорость, на которую она опирается.
+
+    Скорость — измеренная скорость рассылок бота (не выше SEND_RATE_LIMIT),
+    а без измерений — сам лимит. Идущие рассылки того же бота делят её
+    пропорционально весам приоритетов, действующий flood-лимит добавляется.
+    """
+    measured = bot_manager.throughput is not None
+    rate = min(SEND_RATE_LIMIT, bot_manager.throughput) if measured else SEND_RATE_LIMIT
+    weight = PRIORITY_WEIGHTS[priority]
+    running = [job for job in active_jobs.values() if job.bot_manager is bot_manager and isinstance(job, BroadcastJob)]
+    share = weight / (weight + sum(job.weight for job in running))
+    seconds = recipients * plan.cost / max(rate * share, 1e-9)
+    seconds += max(0.0, bot_manager.scheduler.paused_until - time.monotonic())
+    return seconds, rate, measured, len(running)
+
+def format_duration(seconds):
+    seconds = int(round(seconds))
+    if seconds < 60:
+        return f"{seconds} с"
+    minutes, seconds = divmod(seconds, 60)
+    if minutes < 60:
+        return f"{minutes} мин {seconds:02d} с"
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours} ч {minutes:02d} мин"
+
+def notify_admin(bot, chat_id, text, cleanup=None):
+    """Колбэк завершения задачи: освобождает ресурсы и сообщает админу итог."""
+    async def notify(job):
+        if cleanup is not None:
+            cleanup()
+        if chat_id is None:
+            return
+        if job.aborted:
+            final_message = (f"Рассылка поста {job.post_id} через бота {job.bot_manager.name} остановлена после "
+                             f"пробной отправки: {job.aborted}.\nПроверьте пост; отправленные сообщения можно удалить по его ID.")
+        elif job.stopping:
+            final_message = (f"Рассылка поста {job.post_id} через бота {job.bot_manager.name} прервана "
+                             f"перезапуском и продолжится после него.\nДоставлено к этому моменту: {job.sent}.")
+        elif job.cancelled:
+            final_message = (f"Рассылка поста {job.post_id} через бота {job.bot_manager.name} отменена, "
+                             f"доставлено {job.sent} из {job.total}.")
+        else:
+            final_message = f"{text}\nДоставлено: {job.sent} из {job.total}, ошибок: {job.failed}."
+        try:
+            await bot.send_message(chat_id=chat_id, text=escape_markdown_v2(final_message), parse_mode='MarkdownV2')
+        except Exception as e:
+            logging.error(f"Не удалось уведомить админа {chat_id}: {e}")
+    return notify
+
+def notify_post_update(bot, chat_id, on_complete=None):
+    """Колбэк срочной задачи (удаление, правка): on_complete(job) выполняется, только если задача дошла до конца."""
+    async def notify(job):
+        name = job.bot_manager.name
+        if job.stopping or job.cancelled or job.error is not None:
+            final_message = (f"Бот {name}: задача «{job.description}» для поста {job.post_id} прервана, "
+                             f"обработано {job.sent} из {job.total}. Повторите действие.")
+        else:
+            final_message = (f"Бот {name}: задача «{job.description}» для поста {job.post_id} выполнена, "
+                             f"обработано {job.sent} из {job.total}, ошибок {job.failed}.")
+            if on_complete is not None:
+                try:
+                    on_complete(job)
+                except (redis.RedisError, BackendUnavailable) as e:
+                    logging.error(f"Не удалось обновить записи поста {job.post_id} через {job.bot_manager.bot_name}: {e}")
+                    final_message += f"\nЗаписи поста обновить не удалось ({e}). Повторите действие позже."
+        try:
+            await bot.send_message(chat_id=chat_id, text=escape_markdown_v2(final_message), parse_mode='MarkdownV2')
+        except Exception as e:
+            logging.error(f"Не удалось уведомить админа {chat_id}: {e}")
+    return notify
 
 @allowed_users_only
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -304,6 +2249,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
     text = update.message.text
     if text == "📤 Отправить пост":
+        discard_draft(update, context)
         context.user_data.clear()
         await update.message.reply_text(
             "Что вы хотите отправить?",
@@ -311,12 +2257,17 @@ async def admin_commands(update: Update, context: ContextTypes.DEFAULT_TYPE, sen
         )
         return SEND_POST_CHOICES
     elif text == "🎥 Отправить видео-сообщение":
+        discard_draft(update, context)
         context.user_data.clear()
         await update.message.reply_text("Отправьте видео (обычное видео или как файл):", reply_markup=ReplyKeyboardRemove())
         return SEND_VIDEO_NOTE
     elif text == "🎤 Аудиосообщение":
+        discard_draft(update, context)
         context.user_data.clear()
-        await update.message.reply_text("Отправьте аудиосообщение (ваш голос):", reply_markup=ReplyKeyboardRemove())
+        await update.message.reply_text(
+            "Отправьте аудиосообщение (ваш голос), аудиофайл или видео — звук будет перекодирован в голосовое:",
+            reply_markup=ReplyKeyboardRemove()
+        )
         return SEND_POST_AUDIO
     elif text == "✏️ Редактировать пост":
         await update.message.reply_text("Введите ID поста для редактирования:", reply_markup=ReplyKeyboardRemove())
@@ -443,39 +2394,39 @@ async def hide_text_fragment(update: Update, context: ContextTypes.DEFAULT_TYPE)
     context.user_data['media'] = []
     return SEND_POST_MEDIA
 
+def post_media_from_message(message):
+    if message.photo:
+        return message.photo[-1], 'photo', '.jpg'
+    elif message.video:
+        return message.video, 'video', '.mp4'
+    elif message.document and message.document.mime_type.startswith('video/'):
+        return message.document, 'video', '.mp4'
+    return None
+
 @allowed_users_only
 async def send_post_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    if update.message.photo:
-        file_obj = update.message.photo[-1]
-        file_type = 'photo'
-        suffix = '.jpg'
-    elif update.message.video:
-        file_obj = update.message.video
-        file_type = 'video'
-        suffix = '.mp4'
-    elif update.message.document and update.message.document.mime_type.startswith('video/'):
-        file_obj = update.message.document
-        file_type = 'video'
-        suffix = '.mp4'
-    else:
+    post_media = post_media_from_message(update.message)
+    if post_media is None:
         await update.message.reply_text("Пожалуйста, отправьте фото или видео.")
         return SEND_POST_MEDIA
+    file_obj, file_type, suffix = post_media
 
-    try:
-        file = await file_obj.get_file()
-        with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
-            await file.download_to_drive(temp_file.name)
-            temp_file_path = temp_file.name
-    except Exception as e:
-        logging.error(f"Ошибка при скачивании файла: {e}")
-        await update.message.reply_text("Не удалось загрузить файл. Попробуйте снова.")
-        return SEND_POST_MEDIA
-
-    context.user_data['current_media'] = temp_file_path
-    context.user_data['current_media_type'] = file_type
+    # Файл скачивается в фоне, админ тем временем отвечает на вопрос о спойлере
+    context.user_data['current_media'] = draft_media(file_obj, file_type, suffix, draft_owner(update))
     await update.message.reply_text("Скрыть это медиа под спойлером? (Да/Нет)", reply_markup=yes_no_menu())
     return SPOILER_DECISION_MEDIA
 
+@allowed_users_only
+async def queue_post_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Медиа, пришедшие до ответа о спойлере (например, альбом), скачиваются сразу и ждут своей очереди."""
+    post_media = post_media_from_message(update.message)
+    if post_media is not None:
+        file_obj, file_type, suffix = post_media
+        context.user_data.setdefault('queued_media', []).append(
+            draft_media(file_obj, file_type, suffix, draft_owner(update))
+        )
+    return SPOILER_DECISION_MEDIA
+
 @allowed_users_only
 async def spoiler_decision_media(update: Update, context: ContextTypes.DEFAULT_TYPE):
     decision = update.message.text.lower()
@@ -489,18 +2440,21 @@ async def spoiler_decision_media(update: Update, context: ContextTypes.DEFAULT_T
         return SPOILER_DECISION_MEDIA
 
     media_list = context.user_data.get('media', [])
-    media_type = context.user_data.get('current_media_type')
-    file_path = context.user_data.get('current_media')
-
     media_list.append({
-        'type': media_type,
-        'file_path': file_path,
+        **(context.user_data.get('current_media') or {}),
+        'file_path': None,
         'has_spoiler': has_spoiler
     })
 
     context.user_data['media'] = media_list
     context.user_data['current_media'] = None
-    context.user_data['current_media_type'] = None
+
+    queued_media = context.user_data.get('queued_media', [])
+    if queued_media:
+        context.user_data['current_media'] = queued_media.pop(0)
+        await update.message.reply_text("Медиафайл добавлен. Скрыть следующее медиа под спойлером? (Да/Нет)",
+                                        reply_markup=yes_no_menu())
+        return SPOILER_DECISION_MEDIA
 
     await update.message.reply_text("Медиафайл добавлен. Отправьте следующий или введите /done для завершения.")
     return SEND_POST_MEDIA
@@ -517,7 +2471,12 @@ async def send_both_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
 @allowed_users_only
 async def done_send_post_media(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
-    media = context.user_data.get('media', [])
+    media, failed_downloads = await resolve_media_downloads(
+        context.bot, context.user_data.get('media', []), draft_owner(update)
+    )
+    context.user_data['media'] = media
+    if failed_downloads:
+        await update.message.reply_text(f"Не удалось загрузить медиафайлов: {failed_downloads}. Они не войдут в пост.")
     post_text = context.user_data.get('post_text', '')
     post_id = str(uuid.uuid4())
     
@@ -537,7 +2496,19 @@ async def done_send_post_media(update: Update, context: ContextTypes.DEFAULT_TYP
     else:
         await update.message.reply_text("Нечего отправлять. Пожалуйста, начните заново.", reply_markup=admin_main_menu())
         return ADMIN_PANEL
-    
+
+    # План строится здесь же, чтобы недоставляемый пост отклонить до выбора бота, а не после первой отправки
+    try:
+        plan = build_send_plan(post_type, content, data)
+    except UndeliverablePost as e:
+        media_store.release(draft_owner(update))
+        await update.message.reply_text(f"Пост не может быть отправлен: {e}. Пожалуйста, начните заново.",
+                                        reply_markup=admin_main_menu())
+        return ADMIN_PANEL
+    messages_count = sum(len(step['media']) if step['method'] == 'media_group' else 1 for step in plan.steps)
+    if plan.cost > 1:
+        await update.message.reply_text(f"Пост будет отправлен {messages_count} сообщениями "
+                                        f"(лимиты Telegram: {TEXT_LIMIT} символов в тексте, {CAPTION_LIMIT} в подписи).")
 
     context.user_data['post_id'] = post_id
     context.user_data['post_content'] = content
@@ -546,7 +2517,7 @@ async def done_send_post_media(update: Update, context: ContextTypes.DEFAULT_TYP
     
     # Запрашиваем выбор бота для публикации
     await update.message.reply_text(
-        "Выберите бота, в которого опубликовать пост:",
+        "Выберите бота, в которого опубликовать пост (/dryrun — охват и время рассылки без отправки):",
         reply_markup=select_bot_menu(sending_bots)
     )
     return SELECT_BOT_POST
@@ -563,68 +2534,36 @@ async def receive_video_note(update: Update, context: ContextTypes.DEFAULT_TYPE,
     if video or video_file:
         try:
             file = await (video.get_file() if video else video_file.get_file())
-            suffix = '.mp4'
-            with tempfile.NamedTemporaryFile(delete=False, suffix=suffix) as temp_file:
-                await file.download_to_drive(temp_file.name)
-                temp_file_path = temp_file.name
+            temp_file_path = await media_store.download(file, '.mp4', draft_owner(update))
         except Exception as e:
             logging.error(f"Ошибка при скачивании видео: {e}")
             await update.message.reply_text("Не удалось загрузить видео. Попробуйте снова.")
             return SEND_VIDEO_NOTE
 
         try:
-            video_clip = VideoFileClip(temp_file_path)
-            video_size = os.path.getsize(temp_file_path)
-            video_duration = video_clip.duration
-            width, height = video_clip.size
-
-            # Требования Telegram для video_note:
-            MAX_SIZE = 50 * 1024 * 1024  # 50 MB
-            MAX_DURATION = 60  # 60 seconds
-            TARGET_DIMENSION = 640  # Квадратное видео 640x640
-
-            if video_size > MAX_SIZE:
-                await update.message.reply_text("Видео слишком большое для видео-сообщения (максимум 50МБ).")
-                os.remove(temp_file_path)
-                return SEND_VIDEO_NOTE
-
-            if video_duration > MAX_DURATION:
-                await update.message.reply_text("Видео слишком длинное для видео-сообщения (максимум 60 секунд).")
-                os.remove(temp_file_path)
-                return SEND_VIDEO_NOTE
-
-            if abs(width - height) > 10 or (width != TARGET_DIMENSION or height != TARGET_DIMENSION):
-                await update.message.reply_text("Видео не соответствует требуемому формату. Бот автоматически обработает его.")
-
-                new_size = min(width, height)
-                cropped_video = video_clip.crop(x_center=width/2, y_center=height/2, width=new_size, height=new_size)
-                resized_video = cropped_video.resize((TARGET_DIMENSION, TARGET_DIMENSION))
-                resized_video.set_duration(min(video_duration, MAX_DURATION))
-
-                processed_temp_path = temp_file_path.replace('.mp4', '_processed.mp4')
-                resized_video.write_videofile(processed_temp_path, codec='libx264', audio_codec='aac')
-                
-                os.remove(temp_file_path)
-                temp_file_path = processed_temp_path
-
-                video_clip = VideoFileClip(temp_file_path)
-                width, height = video_clip.size
-
-                if os.path.getsize(temp_file_path) > MAX_SIZE:
-                    await update.message.reply_text("Видео после обработки превышает ограничение в 50МБ.")
-                    os.remove(temp_file_path)
-                    return SEND_VIDEO_NOTE
-
+            video_note_path = await asyncio.get_running_loop().run_in_executor(
+                transcode_executor, prepare_video_note_file, temp_file_path
+            )
+        except VideoNoteRejected as e:
+            await update.message.reply_text(str(e))
+            media_store.release(draft_owner(update), temp_file_path)
+            return SEND_VIDEO_NOTE
         except Exception as e:
             logging.error(f"Ошибка при обработке видео: {e}")
             await update.message.reply_text("Не удалось обработать видео.")
-            os.remove(temp_file_path)
+            media_store.release(draft_owner(update), temp_file_path)
             return SEND_VIDEO_NOTE
 
+        if video_note_path != temp_file_path:
+            media_store.acquire(draft_owner(update), video_note_path)
+            media_store.release(draft_owner(update), temp_file_path)
+            temp_file_path = video_note_path
+            await update.message.reply_text("Видео не соответствовало требуемому формату и было обработано автоматически.")
+
         context.user_data['video_path'] = temp_file_path
         await update.message.reply_text("Видео готово к отправке.")
         await update.message.reply_text(
-            "Выберите бота, через которого отправить видео-сообщение:",
+            "Выберите бота, через которого отправить видео-сообщение (/dryrun — охват и время рассылки без отправки):",
             reply_markup=select_bot_menu(sending_bots)
         )
         return SELECT_BOT_VIDEO_AUDIO
@@ -634,28 +2573,48 @@ async def receive_video_note(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 @allowed_users_only
 async def receive_audio(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
-    if update.message.voice:
-        voice = update.message.voice
+    message = update.message
+    if message.voice:
+        file_obj, default_suffix = message.voice, '.ogg'
+    elif message.audio:
+        file_obj, default_suffix = message.audio, '.mp3'
+    elif message.video:
+        file_obj, default_suffix = message.video, '.mp4'
+    elif message.video_note:
+        file_obj, default_suffix = message.video_note, '.mp4'
+    elif message.document and message.document.mime_type and message.document.mime_type.startswith(('audio/', 'video/')):
+        file_obj, default_suffix = message.document, '.bin'
+    else:
+        await update.message.reply_text("Пожалуйста, отправьте аудиосообщение, аудиофайл или видео со звуком.")
+        return SEND_POST_AUDIO
 
+    suffix = os.path.splitext(getattr(file_obj, 'file_name', None) or '')[1] or default_suffix
+    try:
+        file = await file_obj.get_file()
+        temp_file_path = await media_store.download(file, suffix, draft_owner(update))
+    except Exception as e:
+        logging.error(f"Ошибка при скачивании аудиосообщения: {e}")
+        await update.message.reply_text("Не удалось загрузить аудиосообщение. Попробуйте снова.")
+        return SEND_POST_AUDIO
+
+    if not message.voice:
+        await update.message.reply_text("Перекодирую в голосовое сообщение...")
         try:
-            file = await voice.get_file()
-            with tempfile.NamedTemporaryFile(delete=False, suffix='.ogg') as temp_file:
-                await file.download_to_drive(temp_file.name)
-                temp_file_path = temp_file.name
+            voice_path = await transcode_to_voice(temp_file_path, draft_owner(update))
         except Exception as e:
-            logging.error(f"Ошибка при скачивании аудиосообщения: {e}")
-            await update.message.reply_text("Не удалось загрузить аудиосообщение. Попробуйте снова.")
+            logging.error(f"Ошибка при перекодировании аудио: {e}")
+            await update.message.reply_text("Не удалось извлечь звук из файла. Попробуйте другой файл.")
             return SEND_POST_AUDIO
+        finally:
+            media_store.release(draft_owner(update), temp_file_path)
+        temp_file_path = voice_path
 
-        context.user_data['voice_path'] = temp_file_path
-        await update.message.reply_text(
-            "Выберите бота, через которого отправить аудиосообщение:",
-            reply_markup=select_bot_menu(sending_bots)
-        )
-        return SELECT_BOT_VIDEO_AUDIO
-    else:
-        await update.message.reply_text("Пожалуйста, отправьте аудиосообщение (ваш голос).")
-        return SEND_POST_AUDIO
+    context.user_data['voice_path'] = temp_file_path
+    await update.message.reply_text(
+        "Выберите бота, через которого отправить аудиосообщение (/dryrun — охват и время рассылки без отправки):",
+        reply_markup=select_bot_menu(sending_bots)
+    )
+    return SELECT_BOT_VIDEO_AUDIO
 
 @allowed_users_only
 async def select_post_action(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
@@ -664,13 +2623,24 @@ async def select_post_action(update: Update, context: ContextTypes.DEFAULT_TYPE,
 
 
     posts_found = []
+    unavailable = []
     for bot_manager in sending_bots:
-        post_data = bot_manager.get_post(post_id, bot_manager.bot_name)
+        try:
+            post_data = bot_manager.get_post(post_id, bot_manager.bot_name)
+        except (redis.RedisError, BackendUnavailable) as e:
+            logger.warning(f"Бот {bot_manager.name} пропущен при поиске поста {post_id}: {e}")
+            unavailable.append(bot_manager.name)
+            continue
         if post_data:
             posts_found.append(bot_manager)
 
     if not posts_found:
-        await update.message.reply_text("Пост с таким ID не найден. Попробуйте ещё раз.")
+        if unavailable:
+            await update.message.reply_text(
+                f"Пост не найден среди доступных ботов. Сейчас недоступны: {', '.join(unavailable)}. Попробуйте позже."
+            )
+        else:
+            await update.message.reply_text("Пост с таким ID не найден. Попробуйте ещё раз.")
         return SELECT_POST
 
     context.user_data['post_id'] = post_id
@@ -680,23 +2650,44 @@ async def select_post_action(update: Update, context: ContextTypes.DEFAULT_TYPE,
         return EDIT_POST
     elif action == 'delete':
 
-        total_deleted = 0
+        started = []
         for bot_manager in posts_found:
-            post_data = bot_manager.get_post(post_id, bot_manager.bot_name)
-            if not post_data:
+            # Пост на недоступном боте не трогаем, чтобы удаление можно было повторить позже
+            if not bot_manager.available:
+                unavailable.append(bot_manager.name)
                 continue
-            post_type = post_data.get('post_type')
-            data = post_data.get('data')
-            sent_msgs = bot_manager.get_sent_messages(post_id, bot_manager.bot_name)
-            for chat_id, message_id in sent_msgs.items():
-                try:
-                    await bot_manager.bot.delete_message(chat_id=chat_id, message_id=int(message_id))
-                    total_deleted += 1
-                except Exception as e:
-                    logging.error(f"Ошибка при удалении сообщения у пользователя {chat_id} через {bot_manager.bot_name}: {e}")
-            bot_manager.delete_sent_messages(post_id, bot_manager.bot_name)
-            bot_manager.delete_post(post_id, bot_manager.bot_name)
-        final_message = f"Пост удалён."
+            try:
+                await cancel_post_jobs(bot_manager, post_id)
+                sent_msgs = bot_manager.get_sent_messages(post_id, bot_manager.bot_name)
+                # Удаление идёт срочной задачей и обгоняет идущие рассылки
+                job = SendJob(bot_manager, post_id, 'удаление поста', PRIORITY_URGENT)
+                job.total = sum(len(message_ids) for message_ids in sent_msgs.values())
+
+                async def delete_message(message, job=job, bot_manager=bot_manager):
+                    chat_id, message_id = message
+                    try:
+                        await job.call(lambda: bot_manager.bot.delete_message(chat_id=chat_id, message_id=message_id))
+                        job.sent += 1
+                    except Exception as e:
+                        job.failed += 1
+                        logging.error(f"Ошибка при удалении сообщения у пользователя {chat_id} через {bot_manager.bot_name}: {e}")
+
+                def delete_records(job, bot_manager=bot_manager):
+                    bot_manager.delete_sent_messages(post_id, bot_manager.bot_name)
+                    bot_manager.delete_post(post_id, bot_manager.bot_name)
+
+                # Записи поста стираются, только когда удалены все сообщения: прерванное удаление можно повторить
+                start_job(job, job.process(
+                    ((chat_id, message_id) for chat_id, message_ids in sent_msgs.items() for message_id in message_ids),
+                    delete_message
+                ), notify_post_update(context.bot, update.effective_chat.id, on_complete=delete_records))
+                started.append(bot_manager.name)
+            except (redis.RedisError, BackendUnavailable) as e:
+                logger.warning(f"Бот {bot_manager.name} пропущен при удалении поста {post_id}: {e}")
+                unavailable.append(bot_manager.name)
+        final_message = f"Удаление поста запущено: {', '.join(started)}." if started else "Удаление поста не запущено."
+        if unavailable:
+            final_message += f"\nСейчас недоступны {', '.join(unavailable)}. Повторите удаление позже."
         escaped_final_message = escape_markdown_v2(final_message)
         await update.message.reply_text(escaped_final_message, parse_mode='MarkdownV2')
         await update.message.reply_text("Выберите следующее действие:", reply_markup=admin_main_menu())
@@ -711,26 +2702,74 @@ async def edit_post_text(update: Update, context: ContextTypes.DEFAULT_TYPE, sen
     post_id = context.user_data.get('post_id')
 
 
+    unavailable = []
+    posts_found = []
     for bot_manager in sending_bots:
-        post_data = bot_manager.get_post(post_id, bot_manager.bot_name)
+        if not bot_manager.available:
+            unavailable.append(bot_manager.name)
+            continue
+        try:
+            post_data = bot_manager.get_post(post_id, bot_manager.bot_name)
+        except (redis.RedisError, BackendUnavailable) as e:
+            logger.warning(f"Бот {bot_manager.name} пропущен при правке поста {post_id}: {e}")
+            unavailable.append(bot_manager.name)
+            continue
         if not post_data:
             continue
         post_type = post_data.get('post_type')
         data = post_data.get('data')
-        bot_manager.save_post(post_id, new_text, post_type, data, bot_manager.bot_name)
-        sent_msgs = bot_manager.get_sent_messages(post_id, bot_manager.bot_name)
-        escaped_text = escape_markdown_v2(new_text, preserve_markdown=True)
-        for chat_id, message_id in sent_msgs.items():
-            try:
-                if post_type == 'text':
-                    await bot_manager.bot.edit_message_text(chat_id=chat_id, message_id=int(message_id), text=escaped_text, parse_mode='MarkdownV2')
-                elif post_type == 'text_media':
-                    await bot_manager.bot.edit_message_caption(chat_id=chat_id, message_id=int(message_id), caption=escaped_text, parse_mode='MarkdownV2')
+        # Правка меняет текст уже отправленных сообщений, поэтому новый текст должен
+        # разбиться на столько же частей в тех же сообщениях, что и старый
+        try:
+            new_parts = build_send_plan(post_type, new_text, data).text_parts()
+        except UndeliverablePost as e:
+            await update.message.reply_text(f"Этот текст нельзя отправить: {e}. Введите другой текст:")
+            return EDIT_POST
+        old_parts = build_send_plan(post_type, post_data.get('content', ''), data).text_parts()
+        if [part[:2] for part in new_parts] != [part[:2] for part in old_parts]:
+            await update.message.reply_text(
+                f"Новый текст разбивается на {len(new_parts)} сообщ., а отправленный пост — на {len(old_parts)}. "
+                f"Правка возможна, только если число частей совпадает. Введите другой текст:"
+            )
+            return EDIT_POST
+        posts_found.append((bot_manager, post_type, data, new_parts))
+
+    started = []
+    for bot_manager, post_type, data, new_parts in posts_found:
+        try:
+            bot_manager.save_post(post_id, new_text, post_type, data, bot_manager.bot_name)
+            sent_msgs = bot_manager.get_sent_messages(post_id, bot_manager.bot_name)
+        except (redis.RedisError, BackendUnavailable) as e:
+            logger.warning(f"Бот {bot_manager.name} пропущен при правке поста {post_id}: {e}")
+            unavailable.append(bot_manager.name)
+            continue
+        job = SendJob(bot_manager, post_id, 'правка поста', PRIORITY_URGENT)
+        job.total = len(sent_msgs)
 
+        async def edit_message(message, job=job, bot_manager=bot_manager, new_parts=new_parts):
+            chat_id, message_ids = message
+            try:
+                for position, kind, text in new_parts:
+                    if position >= len(message_ids):
+                        # Получатель получил пост не полностью
+                        break
+                    message_id = message_ids[position]
+                    if kind == 'text':
+                        await job.call(lambda: bot_manager.bot.edit_message_text(chat_id=chat_id, message_id=message_id, text=text, parse_mode='MarkdownV2'))
+                    else:
+                        await job.call(lambda: bot_manager.bot.edit_message_caption(chat_id=chat_id, message_id=message_id, caption=text, parse_mode='MarkdownV2'))
+                job.sent += 1
             except Exception as e:
+                job.failed += 1
                 logging.error(f"Ошибка при редактировании сообщения у пользователя {chat_id} через {bot_manager.bot_name}: {e}")
 
-    final_message = f"Пост обновлён."
+        start_job(job, job.process(sent_msgs.items(), edit_message),
+                  notify_post_update(context.bot, update.effective_chat.id))
+        started.append(bot_manager.name)
+
+    final_message = f"Правка поста запущена: {', '.join(started)}." if started else "Правка поста не запущена."
+    if unavailable:
+        final_message += f"\nСейчас недоступны {', '.join(unavailable)}. Повторите правку позже."
     escaped_final_message = escape_markdown_v2(final_message)
     await update.message.reply_text(escaped_final_message, parse_mode='MarkdownV2')
     await update.message.reply_text("Выберите следующее действие:", reply_markup=admin_main_menu())
@@ -747,30 +2786,38 @@ async def select_bot_video_audio(update: Update, context: ContextTypes.DEFAULT_T
         )
         return SELECT_BOT_VIDEO_AUDIO
     selected_bot = selected_bots[0]
+    if not selected_bot.available:
+        await update.message.reply_text(
+            f"Бот {selected_bot.name} сейчас недоступен. Выберите другого бота или попробуйте позже (/health).",
+            reply_markup=select_bot_menu(sending_bots)
+        )
+        return SELECT_BOT_VIDEO_AUDIO
 
 
     if 'video_path' in context.user_data:
         video_path = context.user_data['video_path']
         del context.user_data['video_path']
+        if not os.path.exists(video_path):
+            # Файл черновика не пережил перезапуск
+            await update.message.reply_text("Файл видео утерян. Пожалуйста, отправьте его заново.", reply_markup=admin_main_menu())
+            return ADMIN_PANEL
         try:
-            user_ids = await get_user_ids(selected_bot.redis_client, selected_bot.chat_id_set)
-            successful = 0
             post_id = str(uuid.uuid4())
             # Сохраняем пост
             selected_bot.save_post(post_id, '', 'video_note', video_path, selected_bot.bot_name)
-            for chat_id in user_ids:
-                try:
-
-                    success = await selected_bot.send_video_note(chat_id, video_path)
-                    if success:
-                        successful += 1
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке видео-сообщения пользователю {chat_id} через {selected_bot.bot_name}: {e}")
-            try:
-                os.remove(video_path)
-            except Exception as e:
-                logging.error(f"Не удалось удалить временный файл {video_path}: {e}")
-            final_message = f"Видеосообщение отправлено через бота {selected_bot.name}.\nID поста: {post_id}."
+            snapshot = await asyncio.to_thread(AudienceSnapshot.create, selected_bot, post_id)
+            media_store.acquire(post_id, video_path)
+            media_store.release(draft_owner(update), video_path)
+            job = BroadcastJob(
+                selected_bot, post_id, snapshot, build_send_plan('video_note', '', video_path),
+                'видеосообщение', PRIORITY_BULK, update.effective_chat.id
+            )
+            start_job(job, job.run(canary=CANARY_ENABLED), notify_admin(
+                context.bot, update.effective_chat.id,
+                f"Видеосообщение отправлено через бота {selected_bot.name}.\nID поста: {post_id}.",
+                cleanup=lambda: media_store.release(post_id)
+            ))
+            final_message = f"Рассылка видеосообщения запущена через бота {selected_bot.name}.\nID поста: {post_id}."
             escaped_final_message = escape_markdown_v2(final_message)
             await update.message.reply_text(escaped_final_message, parse_mode='MarkdownV2')
             await update.message.reply_text("Выберите следующее действие:", reply_markup=admin_main_menu())
@@ -783,24 +2830,27 @@ async def select_bot_video_audio(update: Update, context: ContextTypes.DEFAULT_T
     elif 'voice_path' in context.user_data:
         voice_path = context.user_data['voice_path']
         del context.user_data['voice_path']
+        if not os.path.exists(voice_path):
+            # Файл черновика не пережил перезапуск
+            await update.message.reply_text("Файл аудио утерян. Пожалуйста, отправьте его заново.", reply_markup=admin_main_menu())
+            return ADMIN_PANEL
         try:
-            user_ids = await get_user_ids(selected_bot.redis_client, selected_bot.chat_id_set)
-            successful = 0
             post_id = str(uuid.uuid4())
 
             selected_bot.save_post(post_id, '', 'audio', voice_path, selected_bot.bot_name)
-            for chat_id in user_ids:
-                try:
-                    success = await selected_bot.send_voice(chat_id, voice_path)
-                    if success:
-                        successful += 1
-                except Exception as e:
-                    logging.error(f"Ошибка при отправке аудиосообщения пользователю {chat_id} через {selected_bot.bot_name}: {e}")
-            try:
-                os.remove(voice_path)
-            except Exception as e:
-                logging.error(f"Не удалось удалить временный файл {voice_path}: {e}")
-            final_message = f"Аудиосообщение отправлено через бота {selected_bot.name}.\nID поста: {post_id}."
+            snapshot = await asyncio.to_thread(AudienceSnapshot.create, selected_bot, post_id)
+            media_store.acquire(post_id, voice_path)
+            media_store.release(draft_owner(update), voice_path)
+            job = BroadcastJob(
+                selected_bot, post_id, snapshot, build_send_plan('audio', '', voice_path),
+                'аудиосообщение', PRIORITY_BULK, update.effective_chat.id
+            )
+            start_job(job, job.run(canary=CANARY_ENABLED), notify_admin(
+                context.bot, update.effective_chat.id,
+                f"Аудиосообщение отправлено через бота {selected_bot.name}.\nID поста: {post_id}.",
+                cleanup=lambda: media_store.release(post_id)
+            ))
+            final_message = f"Рассылка аудиосообщения запущена через бота {selected_bot.name}.\nID поста: {post_id}."
             escaped_final_message = escape_markdown_v2(final_message)
             await update.message.reply_text(escaped_final_message, parse_mode='MarkdownV2')
             await update.message.reply_text("Выберите следующее действие:", reply_markup=admin_main_menu())
@@ -824,42 +2874,51 @@ async def select_bot_post(update: Update, context: ContextTypes.DEFAULT_TYPE, se
         )
         return SELECT_BOT_POST
     selected_bot = selected_bots[0]
+    if not selected_bot.available:
+        await update.message.reply_text(
+            f"Бот {selected_bot.name} сейчас недоступен. Выберите другого бота или попробуйте позже (/health).",
+            reply_markup=select_bot_menu(sending_bots)
+        )
+        return SELECT_BOT_POST
     
 
     post_id = context.user_data.get('post_id')
     content = context.user_data.get('post_content')
     post_type = context.user_data.get('post_type')
     data = context.user_data.get('post_data')
-    
+    if post_type in ('media', 'text_media'):
+        # Черновик мог пережить перезапуск, а его файлы — нет
+        media, failed_downloads = await resolve_media_downloads(context.bot, json.loads(data), draft_owner(update))
+        if failed_downloads:
+            discard_draft(update, context)
+            context.user_data.clear()
+            await update.message.reply_text(f"Не удалось восстановить медиафайлов поста: {failed_downloads}. "
+                                            f"Пожалуйста, начните заново.", reply_markup=admin_main_menu())
+            return ADMIN_PANEL
+        data = json.dumps(media)
+    try:
+        plan = build_send_plan(post_type, content, data)
+    except UndeliverablePost as e:
+        await update.message.reply_text(f"Пост не может быть отправлен: {e}.", reply_markup=admin_main_menu())
+        return ADMIN_PANEL
 
     selected_bot.save_post(post_id, content, post_type, data, selected_bot.bot_name)
-    
-
-    all_successful = 0
-    user_ids = await get_user_ids(selected_bot.redis_client, selected_bot.chat_id_set)
-    successful = 0
-    for chat_id in user_ids:
-        try:
-            if post_type == 'text':
-                success = await selected_bot.send_text_message(chat_id, content)
-                if success:
-                    successful += 1
-            elif post_type == 'media':
-                media = json.loads(data)
-                success = await selected_bot.send_media_group(chat_id, media)
-                if success:
-                    successful += 1
-            elif post_type == 'text_media':
-                media = json.loads(data)
-                success = await selected_bot.send_media_group(chat_id, media, caption=content)
-                if success:
-                    successful += 1
-        except Exception as e:
-            logging.error(f"Ошибка при отправке поста пользователю {chat_id} через {selected_bot.name}: {e}")
-    all_successful += successful
-    
+    for path in post_media_paths(post_type, data):
+        media_store.acquire(post_id, path)
+    media_store.release(draft_owner(update))
+
+    snapshot = await asyncio.to_thread(AudienceSnapshot.create, selected_bot, post_id)
+    job = BroadcastJob(
+        selected_bot, post_id, snapshot, plan,
+        'пост', broadcast_priority(post_type), update.effective_chat.id
+    )
+    start_job(job, job.run(canary=CANARY_ENABLED), notify_admin(
+        context.bot, update.effective_chat.id,
+        f"Пост отправлен через бота {selected_bot.name}.\nID поста: {post_id}.",
+        cleanup=lambda: media_store.release(post_id)
+    ))
 
-    final_message = f"Пост отправлен через бота {selected_bot.name}.\nID поста: {post_id}."
+    final_message = f"Рассылка поста запущена через бота {selected_bot.name}.\nID поста: {post_id}."
     escaped_final_message = escape_markdown_v2(final_message)
     await update.message.reply_text(escaped_final_message, parse_mode='MarkdownV2')
     
@@ -872,29 +2931,9 @@ async def select_bot_post(update: Update, context: ContextTypes.DEFAULT_TYPE, se
 
 @allowed_users_only
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
-    media = context.user_data.get('media', [])
-    for item in media:
-        file_path = item.get('file_path')
-        if file_path and os.path.exists(file_path):
-            try:
-                os.remove(file_path)
-            except Exception as e:
-                logging.error(f"Не удалось удалить временный файл {file_path}: {e}")
-    voice_path = context.user_data.get('voice_path')
-    if voice_path and os.path.exists(voice_path):
-        try:
-            os.remove(voice_path)
-        except Exception as e:
-            logging.error(f"Не удалось удалить временный файл {voice_path}: {e}")
+    discard_draft(update, context)
 
-    video_path = context.user_data.get('video_path')
-    if video_path and os.path.exists(video_path):
-        try:
-            os.remove(video_path)
-        except Exception as e:
-            logging.error(f"Не удалось удалить временный файл {video_path}: {e}")
-
-    keys_to_remove = ['spoiler_text', 'post_text', 'media', 'current_media', 'current_media_type', 
+    keys_to_remove = ['spoiler_text', 'post_text', 'media', 'current_media', 'queued_media',
                       'audio', 'current_audio', 'action', 'post_id', 'voice_path', 'video_path']
     for key in keys_to_remove:
         if key in context.user_data:
@@ -905,6 +2944,99 @@ async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bot
     )
     return ADMIN_PANEL
 
+@allowed_users_only
+async def show_jobs(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Показывает идущие задачи отправки и их скорость."""
+    if active_jobs:
+        text = "Идущие задачи:\n" + "\n".join(job.status_line() for job in active_jobs.values())
+    else:
+        text = "Сейчас нет идущих рассылок."
+    await update.message.reply_text(text)
+
+@allowed_users_only
+async def dry_run(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
+    """Прикидка рассылки без обращения к Telegram: охват, план отправки и ожидаемое время по каждому боту."""
+    if 'video_path' in context.user_data:
+        post_type, content, data = 'video_note', '', context.user_data['video_path']
+    elif 'voice_path' in context.user_data:
+        post_type, content, data = 'audio', '', context.user_data['voice_path']
+    else:
+        post_type = context.user_data.get('post_type')
+        content = context.user_data.get('post_content')
+        data = context.user_data.get('post_data')
+    state = SELECT_BOT_VIDEO_AUDIO if post_type in ('video_note', 'audio') else SELECT_BOT_POST
+    if post_type is None:
+        await update.message.reply_text("Нет подготовленного поста. Пожалуйста, начните заново.")
+        return state
+
+    try:
+        plan = build_send_plan(post_type, content, data)
+    except UndeliverablePost as e:
+        await update.message.reply_text(f"Пост не может быть отправлен: {e}.")
+        return state
+    priority = broadcast_priority(post_type) if state == SELECT_BOT_POST else PRIORITY_BULK
+    messages_count = sum(len(step['media']) if step['method'] == 'media_group' else 1 for step in plan.steps)
+
+    lines = [f"Пробный прогон (в Telegram ничего не отправлено).\n"
+             f"План: {plan.cost} вызов(ов) Bot API и {messages_count} сообщ. на получателя."]
+    missing = [path for path in post_media_paths(post_type, data) if not os.path.exists(path)]
+    if missing:
+        lines.append(f"Не найдено медиафайлов: {len(missing)}. Пост нужно собрать заново.")
+    if CANARY_ENABLED:
+        lines.append(f"Сначала пробная отправка: админам и {CANARY_SIZE} получателям.")
+
+    for bot_manager in sending_bots:
+        try:
+            recipients, quarantined = await asyncio.to_thread(bot_manager.audience_size)
+            await asyncio.to_thread(bot_manager.load_stats)
+        except (redis.RedisError, BackendUnavailable) as e:
+            lines.append(f"\n{bot_manager.name}: недоступен ({e}).")
+            continue
+        seconds, rate, measured, running = estimate_broadcast(bot_manager, recipients, plan, priority)
+        line = (f"\n{bot_manager.name}: получателей {recipients}"
+                f"{f' (в карантине ещё {quarantined})' if QUARANTINE_ENABLED else ''}, "
+                f"≈ {format_duration(seconds)} при {rate:.1f} вызовов/с "
+                f"({'измерено по прошлым рассылкам' if measured else 'лимит бота, измерений ещё нет'})")
+        if running:
+            line += f", с учётом идущих рассылок: {running}"
+        if bot_manager.latency is not None:
+            # Каждый воркер держит один запрос, поэтому для выхода на лимит нужно около лимит × задержка воркеров
+            needed = max(1, int(SEND_RATE_LIMIT * bot_manager.latency + 0.999))
+            line += f". Средняя задержка вызова {bot_manager.latency * 1000:.0f} мс: для {SEND_RATE_LIMIT:.0f} вызовов/с нужно воркеров не меньше {needed} (сейчас {BROADCAST_WORKERS})"
+        if not bot_manager.available:
+            line += ". Сейчас бот недоступен (/health)"
+        lines.append(line + ".")
+
+    lines.append("\nВыберите бота для рассылки или /cancel.")
+    await update.message.reply_text("\n".join(lines))
+    return state
+
+@allowed_users_only
+async def show_health(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
+    """Показывает состояние Redis и Bot API каждого отправляющего бота."""
+    await update.message.reply_text("Состояние ботов:\n" + "\n".join(bot_manager.health_line() for bot_manager in sending_bots))
+
+@allowed_users_only
+async def unquarantine(update: Update, context: ContextTypes.DEFAULT_TYPE, sending_bots):
+    """Возвращает чат из карантина всех ботов: /unquarantine <chat_id>."""
+    try:
+        chat_id = int(context.args[0])
+    except (IndexError, ValueError):
+        await update.message.reply_text("Использование: /unquarantine <chat_id>")
+        return
+    released = []
+    for bot_manager in sending_bots:
+        try:
+            if await asyncio.to_thread(bot_manager.release_quarantine, chat_id):
+                released.append(bot_manager.name)
+        except (redis.RedisError, BackendUnavailable) as e:
+            logging.error(f"Не удалось вернуть чат {chat_id} из карантина бота {bot_manager.name}: {e}")
+            await update.message.reply_text(f"{bot_manager.name}: недоступен ({e}).")
+    if released:
+        await update.message.reply_text(f"Чат {chat_id} возвращён в рассылки: {', '.join(released)}.")
+    else:
+        await update.message.reply_text(f"Чат {chat_id} не в карантине.")
+
 @allowed_users_only
 async def unknown(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(
@@ -917,6 +3049,46 @@ async def error_handler(update: object, context: ContextTypes.DEFAULT_TYPE) -> N
     """Ловит все исключения, которые не были обработаны ранее."""
     logger.error(msg="Exception while handling an update:", exc_info=context.error)
 
+# Сколько секунд при остановке ждать идущие рассылки (Railway даёт около 30 с до SIGKILL)
+SHUTDOWN_DEADLINE = float(os.getenv('SHUTDOWN_DEADLINE', '20'))
+
+async def health_monitor_loop(sending_bots):
+    """Периодически проверяет бэкенды с открытым размыкателем, чтобы бот вернулся в строй без чужих запросов."""
+    while True:
+        await asyncio.sleep(HEALTH_CHECK_INTERVAL)
+        for bot_manager in sending_bots:
+            try:
+                await bot_manager.check_health()
+            except Exception as e:
+                logging.error(f"Ошибка проверки состояния бота {bot_manager.name}: {e}")
+
+async def post_init(application, sending_bots):
+    logger.info(f"Админский бот готов к работе через {time.monotonic() - STARTED_AT:.2f} с после запуска.")
+    # Возобновление рассылок идёт в фоне, чтобы медленный Redis не задерживал ответы админам
+    background_tasks.append(asyncio.create_task(resume_jobs_loop(application.bot, sending_bots)))
+    background_tasks.append(asyncio.create_task(health_monitor_loop(sending_bots)))
+    background_tasks.append(asyncio.create_task(run_migrations(sending_bots)))
+    # Прогреваем тяжёлые медиа-библиотеки в фоне, не задерживая приём обновлений
+    asyncio.get_running_loop().run_in_executor(None, load_video_file_clip)
+
+async def post_stop(application, sending_bots):
+    """Останавливает рассылки до дедлайна: курсоры и доставки сохраняются в Redis."""
+    # Фоновые задачи останавливаются первыми, чтобы во время остановки не подхватывались новые рассылки
+    for task in background_tasks:
+        task.cancel()
+    await asyncio.gather(*background_tasks, return_exceptions=True)
+    await drain_jobs(SHUTDOWN_DEADLINE)
+    cancel_media_downloads(list(pending_downloads))
+
+async def post_shutdown(application, sending_bots):
+    """Закрывает пулы соединений после того, как PTB сбросил состояние разговоров."""
+    transcode_executor.shutdown(wait=False, cancel_futures=True)
+    for bot_manager in sending_bots:
+        await bot_manager.close()
+    persistence_redis = application.persistence.redis_client if application.persistence else None
+    if persistence_redis is not None and all(persistence_redis is not bm.redis_client for bm in sending_bots):
+        persistence_redis.close()
+
 def main():
 
     sending_bots_configs = [
@@ -956,7 +3128,17 @@ def main():
         return
 
     # Создаем админское приложение
-    admin_app = ApplicationBuilder().token(ADMIN_BOT_TOKEN).build()
+    admin_app = (
+        ApplicationBuilder()
+        .token(ADMIN_BOT_TOKEN)
+        .request(build_http_request(8))
+        .persistence(RedisPersistence(build_persistence_redis(sending_bots), PERSISTENCE_PREFIX, PERSISTENCE_INTERVAL))
+        .concurrent_updates(PerUserUpdateProcessor(CONCURRENT_UPDATES))
+        .post_init(lambda application: post_init(application, sending_bots))
+        .post_stop(lambda application: post_stop(application, sending_bots))
+        .post_shutdown(lambda application: post_shutdown(application, sending_bots))
+        .build()
+    )
     admin_app.add_error_handler(error_handler)
 
 
@@ -964,6 +3146,8 @@ def main():
 
     # Добавляем обработчики разговоров
     conversation_handler = ConversationHandler(
+        name='admin_conversation',
+        persistent=True,
         entry_points=[CommandHandler('start', start)],
         states={
             ADMIN_PANEL: [
@@ -996,10 +3180,15 @@ def main():
             ],
             SPOILER_DECISION_MEDIA: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, spoiler_decision_media),
+                MessageHandler(filters.PHOTO | filters.VIDEO | filters.Document.VIDEO, queue_post_media),
                 CommandHandler('cancel', lambda update, context: cancel(update, context, sending_bots)),
             ],
             SEND_POST_AUDIO: [
-                MessageHandler(filters.VOICE, lambda update, context: receive_audio(update, context, sending_bots)),
+                MessageHandler(
+                    filters.VOICE | filters.AUDIO | filters.VIDEO | filters.VIDEO_NOTE
+                    | filters.Document.AUDIO | filters.Document.VIDEO,
+                    lambda update, context: receive_audio(update, context, sending_bots)
+                ),
                 CommandHandler('cancel', lambda update, context: cancel(update, context, sending_bots)),
             ],
             SEND_VIDEO_NOTE: [
@@ -1020,10 +3209,12 @@ def main():
             ],
             SELECT_BOT_VIDEO_AUDIO: [ 
                 MessageHandler(filters.TEXT & ~filters.COMMAND, lambda update, context: select_bot_video_audio(update, context, sending_bots)),
+                CommandHandler('dryrun', lambda update, context: dry_run(update, context, sending_bots)),
                 CommandHandler('cancel', lambda update, context: cancel(update, context, sending_bots)),
             ],
             SELECT_BOT_POST: [
                 MessageHandler(filters.TEXT & ~filters.COMMAND, lambda update, context: select_bot_post(update, context, sending_bots)),
+                CommandHandler('dryrun', lambda update, context: dry_run(update, context, sending_bots)),
                 CommandHandler('cancel', lambda update, context: cancel(update, context, sending_bots)),
             ],
             SELECT_BOT: [
@@ -1033,13 +3224,27 @@ def main():
         },
         fallbacks=[
             CommandHandler('cancel', lambda update, context: cancel(update, context, sending_bots)),
+            CommandHandler('jobs', show_jobs),
+            CommandHandler('health', lambda update, context: show_health(update, context, sending_bots)),
+            CommandHandler('unquarantine', lambda update, context: unquarantine(update, context, sending_bots)),
             MessageHandler(filters.ALL, unknown)
         ],
     )
     admin_app.add_handler(conversation_handler)
 
-    print("Админский бот запущен...")
-    admin_app.run_polling()
+    if WEBHOOK_URL:
+        print(f"Админский бот запущен в режиме webhook ({WEBHOOK_URL}/{WEBHOOK_PATH})...")
+        admin_app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=Update.ALL_TYPES
+        )
+    else:
+        print("Админский бот запущен...")
+        admin_app.run_polling(allowed_updates=Update.ALL_TYPES)
 
 
 
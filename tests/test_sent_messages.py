@@ -0,0 +1,80 @@
+import os
+import sys
+
+import pytest
+
+fakeredis = pytest.importorskip('fakeredis')
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import AudienceSnapshot, SendingBotManager
+
+
+@pytest.fixture
+def bot_manager():
+    server = fakeredis.FakeServer()
+    manager = SendingBotManager.__new__(SendingBotManager)
+    manager.name = manager.bot_name = 'Test'
+    manager.chat_id_set = 'chats'
+    manager.redis_client = fakeredis.FakeRedis(server=server, decode_responses=True)
+    manager.redis_binary = fakeredis.FakeRedis(server=server)
+    manager.redis_client.sadd('chats', *range(1, 11), -1001234567890)
+    return manager
+
+
+def deliver(snapshot, deliveries):
+    for chat_id, message_ids in deliveries.items():
+        snapshot.mark_delivered(snapshot.offset_of(chat_id), message_ids)
+    snapshot.flush()
+
+
+def expected(deliveries):
+    return {str(chat_id): message_ids for chat_id, message_ids in deliveries.items()}
+
+
+def test_round_trip_through_compaction(bot_manager):
+    snapshot = AudienceSnapshot.create(bot_manager, 'post')
+    deliveries = {
+        1: [100],
+        2: [101, 102, 103],  # альбом
+        3: [200, 205],  # несмежные id: первое сообщение и повтор оставшихся шагов
+        -1001234567890: [7],
+    }
+    deliver(snapshot, deliveries)
+    # Админ вне снимка аудитории, получивший пробную отправку
+    bot_manager.add_sent_message('post', 999, [300, 301], 'Test')
+    deliveries[999] = [300, 301]
+
+    assert bot_manager.get_sent_messages('post', 'Test') == expected(deliveries)
+    bot_manager.compact_sent_messages('post')
+    assert bot_manager.get_sent_messages('post', 'Test') == expected(deliveries)
+
+    # В хэше остались только те, кого нельзя упаковать
+    residual = bot_manager.redis_client.hgetall(AudienceSnapshot.messages_key('Test', 'post'))
+    assert residual == {'3': '200,205', '999': '300,301'}
+
+
+def test_recompaction_after_resumed_job(bot_manager):
+    snapshot = AudienceSnapshot.create(bot_manager, 'post')
+    first = {1: [10, 11], 4: [12]}
+    deliver(snapshot, first)
+    bot_manager.compact_sent_messages('post')
+
+    # Продолженная рассылка загружает снимок заново и дописывает доставки
+    resumed = AudienceSnapshot.load(bot_manager, 'post')
+    assert resumed.is_delivered(resumed.offset_of(1)) and not resumed.is_delivered(resumed.offset_of(5))
+    second = {5: [20, 21, 22], 6: [30, 40]}
+    deliver(resumed, second)
+    assert bot_manager.get_sent_messages('post', 'Test') == expected({**first, **second})
+
+    bot_manager.compact_sent_messages('post')
+    assert bot_manager.get_sent_messages('post', 'Test') == expected({**first, **second})
+
+
+def test_delete_removes_packed_and_residual_messages(bot_manager):
+    snapshot = AudienceSnapshot.create(bot_manager, 'post')
+    deliver(snapshot, {1: [1], 2: [5, 9]})
+    bot_manager.compact_sent_messages('post')
+
+    bot_manager.delete_sent_messages('post', 'Test')
+    assert bot_manager.get_sent_messages('post', 'Test') == {}
@@ -0,0 +1,94 @@
+import os
+import re
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from main import (
+    CAPTION_LIMIT, TEXT_LIMIT, UndeliverablePost, build_send_plan, render_post_text, split_post_text,
+    telegram_length
+)
+
+
+def squashed(text):
+    return re.sub(r'\s+', '', text)
+
+
+def assert_parts_fit(parts, limit, first_limit=None):
+    assert parts
+    for index, part in enumerate(parts):
+        assert telegram_length(part) <= (first_limit if index == 0 and first_limit else limit)
+
+
+def test_short_text_is_single_part():
+    assert split_post_text("Привет, мир!", TEXT_LIMIT) == [render_post_text("Привет, мир!")]
+
+
+def test_empty_text_has_no_parts():
+    assert split_post_text("   ", TEXT_LIMIT) == []
+
+
+def test_length_is_counted_in_utf16_units():
+    # Каждый эмодзи вне BMP — суррогатная пара, то есть две единицы UTF-16
+    text = "😀😀 " * 1200
+    assert len(text) < TEXT_LIMIT < telegram_length(text)
+    parts = split_post_text(text, TEXT_LIMIT)
+    assert len(parts) == 2
+    assert_parts_fit(parts, TEXT_LIMIT)
+    assert squashed(''.join(parts)) == squashed(text)
+
+
+def test_long_word_is_split_between_characters():
+    parts = split_post_text("😀" * 3000, TEXT_LIMIT)
+    assert_parts_fit(parts, TEXT_LIMIT)
+    assert ''.join(parts) == "😀" * 3000
+
+
+def test_spoiler_longer_than_limit_becomes_several_spoilers():
+    text = "До спойлера. ||" + "скрытое слово " * 700 + "|| После."
+    parts = split_post_text(text, TEXT_LIMIT)
+    assert len(parts) > 1
+    assert_parts_fit(parts, TEXT_LIMIT)
+    for part in parts:
+        assert part.count('||') % 2 == 0
+    assert squashed(''.join(parts).replace('||', '')) == squashed(render_post_text(text).replace('||', ''))
+
+
+def test_caption_then_text_messages():
+    text = "\n".join(f"Строка номер {i} с текстом поста." for i in range(300))
+    parts = split_post_text(text, TEXT_LIMIT, first_limit=CAPTION_LIMIT)
+    assert len(parts) > 2
+    assert_parts_fit(parts, TEXT_LIMIT, first_limit=CAPTION_LIMIT)
+    # Разрезы приходятся на переводы строки
+    for part in parts:
+        assert part.startswith("Строка номер") and part.endswith("поста\\.")
+
+
+def test_text_media_plan_moves_overflow_to_text_messages():
+    text = "слово " * 1000
+    plan = build_send_plan('text_media', text, '[{"type": "photo", "file_path": "a.jpg", "has_spoiler": false}]')
+    assert plan.steps[0]['method'] == 'photo'
+    assert telegram_length(plan.steps[0]['caption']) <= CAPTION_LIMIT
+    assert [step['method'] for step in plan.steps[1:]] == ['text'] * (len(plan.steps) - 1)
+    assert all(telegram_length(step['text']) <= TEXT_LIMIT for step in plan.steps[1:])
+
+
+def test_underscores_in_link_urls_do_not_block_cuts():
+    text = ' '.join(f"пункт{i} [ссылка](https://example.com/a_b/{i})" for i in range(400))
+    parts = split_post_text(text, TEXT_LIMIT)
+    assert len(parts) > 1
+    assert_parts_fit(parts, TEXT_LIMIT)
+    for part in parts:
+        assert len(re.findall(r'\[ссылка\]\(https://example\.com/a_b/\d+\)', part)) == part.count('[')
+
+
+def test_unclosed_formatting_is_undeliverable():
+    with pytest.raises(UndeliverablePost):
+        split_post_text("*" + "жирный текст " * 500, TEXT_LIMIT)
+
+
+def test_link_longer_than_limit_is_undeliverable():
+    with pytest.raises(UndeliverablePost):
+        split_post_text("[ссылка](https://example.com/" + "a" * TEXT_LIMIT + ")", TEXT_LIMIT)